@@ -40,10 +40,39 @@ graph_builder.add_edge("chatbot", END)
 graph = graph_builder.compile()
 
 # run the chatbot
+# def stream_graph_updates(user_input: str):
+#     for event in graph.stream({"messages": [{"role": "user", "content": user_input}]}):
+#         for value in event.values():
+#             print("Assistant:", value["messages"][-1].content)
+
+# stream token deltas as the model produces them, instead of waiting for the whole node update
+# time-to-first-token is the latency the user perceives, tokens/sec is the decode rate after it
+import time
+
+from langchain_core.messages import AIMessageChunk
+
+
 def stream_graph_updates(user_input: str):
-    for event in graph.stream({"messages": [{"role": "user", "content": user_input}]}):
-        for value in event.values():
-            print("Assistant:", value["messages"][-1].content)
+    start = time.perf_counter()
+    first_token = None
+    tokens = 0
+    for chunk, metadata in graph.stream(
+        {"messages": [{"role": "user", "content": user_input}]},
+        stream_mode="messages",
+    ):
+        if not isinstance(chunk, AIMessageChunk) or not chunk.content:
+            continue
+        if first_token is None:
+            first_token = time.perf_counter()
+            node = metadata["langgraph_node"]
+            print("Assistant: ", end="")
+        tokens += 1
+        print(chunk.content, end="", flush=True)
+    if first_token is None:
+        return
+    end = time.perf_counter()
+    tokens_per_sec = (tokens - 1) / (end - first_token) if end > first_token else 0.0
+    print(f"\n[{node}] time to first token {first_token - start:.2f}s, {tokens_per_sec:.1f} tokens/s")
 
 
 while True:
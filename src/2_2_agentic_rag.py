@@ -9,54 +9,442 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # preprocessing documents
-from langchain_community.document_loaders import WebBaseLoader
+# from langchain_community.document_loaders import WebBaseLoader
 
-urls = [
-    "https://lilianweng.github.io/posts/2024-11-28-reward-hacking/",
-    "https://lilianweng.github.io/posts/2024-07-07-hallucination/",
-    "https://lilianweng.github.io/posts/2024-04-12-diffusion-video/",
-]
+# the pages, loader, chunking and chunk ids are shared with 4_6_generate_synthetic_dataset_using_RAG.py (see rag_corpus.py)
+from rag_corpus import CHUNK_OVERLAP, CHUNK_SIZE, URLS as urls, fingerprint, web_loader, with_chunk_ids
 
-# solve below error
+# load the pages in parallel through an on-disk HTTP cache instead of WebBaseLoader (see web_loader.py)
+import hashlib
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from langchain_core.documents import Document
+
+
+# the cache solves below error: a failing page is retried with backoff and no longer aborts the whole load
 # urllib3.exceptions.MaxRetryError: HTTPSConnectionPool(host='lilianweng.github.io', port=443): 
 #     Max retries exceeded with url: /posts/2024-11-28-reward-hacking/ 
 #     (Caused by SSLError(SSLEOFError(8, '[SSL: UNEXPECTED_EOF_WHILE_READING] EOF occurred in violation of protocol (_ssl.c:1028)')))
-loader = WebBaseLoader(urls)
-loader.requests_per_second = 1
-docs = loader.aload()
+current_dir = os.path.dirname(os.path.abspath(__file__))
+loader = web_loader(urls)
+
+
+def load_documents(urls):
+    # loader = WebBaseLoader(urls)
+    # loader.requests_per_second = 1
+    loader.urls = urls
+    docs = loader.load(resume=os.environ.get("RESUME_CRAWL") == "1")
+    print(f"Loaded {len(docs)} pages: {dict(loader.stats)}")
+    for url, error in loader.failed.items():
+        print(f"Failed to load {url}: {error}")
+
+    # print(docs[0][0].page_content.strip()[:1000])
+
+    # docs_list = [item for sublist in docs for item in sublist]
+    return [item for item in docs]
 
-# print(docs[0][0].page_content.strip()[:1000])
 
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
-# docs_list = [item for sublist in docs for item in sublist]
-docs_list = [item for item in docs]
+# split with cached token counts: the recursive splitter measures every piece of text when it is split,
+# again when it is merged and again when it leaves the overlap window, so each piece is encoded only once here
+# (see rag_index.py)
+from rag_index import CachedTokenTextSplitter
+
+
+def compare_splitters(docs, reference, candidate) -> bool:
+    """Check that `candidate` produces exactly the chunks of `reference` on a golden corpus."""
+    mismatches = 0
+    for doc in docs:
+        expected = [chunk.page_content for chunk in reference.split_documents([doc])]
+        actual = [chunk.page_content for chunk in candidate.split_documents([doc])]
+        mismatches += expected != actual
+    print(f"{len(docs) - mismatches}/{len(docs)} documents split identically")
+    return mismatches == 0
+
 
-text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-    chunk_size=50, chunk_overlap=25
+def benchmark_splitter(splitter, docs) -> float:
+    """Return the splitting throughput in MB/s."""
+    size = sum(len(doc.page_content.encode("utf-8")) for doc in docs) / 1e6
+    start = time.perf_counter()
+    n_chunks = sum(len(splitter.split_documents([doc])) for doc in docs)
+    elapsed = time.perf_counter() - start
+    print(f"{type(splitter).__name__}: {n_chunks} chunks, {size / elapsed:.2f} MB/s")
+    return size / elapsed
+
+
+text_splitter = CachedTokenTextSplitter(
+    chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
 )
-doc_splits = text_splitter.split_documents(docs_list)
+
+# reference_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+#     chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP
+# )
+# golden_docs = load_documents(urls)
+# compare_splitters(golden_docs, reference_splitter, text_splitter)
+# benchmark_splitter(reference_splitter, golden_docs)
+# benchmark_splitter(CachedTokenTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP), golden_docs)
+
+
+def iter_splits(docs, text_splitter):
+    """Split documents one at a time so that chunks can be embedded while later documents are still being split."""
+    yield from text_splitter.iter_split_documents(docs)
 
 # create a retriever tool
-from langchain_core.vectorstores import InMemoryVectorStore
 from langchain_ollama import OllamaEmbeddings
 
 embeddings = OllamaEmbeddings(
     model=os.environ["MODEL"],
 )
 
-vectorstore = InMemoryVectorStore.from_documents(
-    documents=doc_splits, 
-    embedding=embeddings
+# cache embeddings on disk so that unchanged chunks are never re-embedded on restart
+import sqlite3
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class SQLiteEmbeddingCache(Embeddings):
+    """Content-addressed embedding cache stored in a local SQLite file.
+
+    Entries are keyed by (model name, sha256 of the chunk text). When the cache
+    holds more than `max_entries` vectors, the least recently used ones are evicted.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, path: str, max_entries: int = 1_000_000):
+        self.embeddings = embeddings
+        self.model = model
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the connection is shared by the ingestion threads, so every access goes through the lock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # counted once, then kept up to date by the inserts and evictions of this process
+        (self._size,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+
+    @staticmethod
+    def _key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _lookup(self, keys: list[str]) -> dict[str, list[float]]:
+        found = {}
+        # stay below SQLite's limit on the number of bound variables
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self._conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(batch))})",
+                [self.model, *batch],
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def _evict(self):
+        if self._size > self.max_entries:
+            cursor = self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (self._size - self.max_entries,),
+            )
+            self._size -= cursor.rowcount
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            found = self._lookup(list(set(keys)))
+            missing = {key: text for key, text in zip(keys, texts) if key not in found}
+            misses = sum(1 for key in keys if key in missing)
+            self.hits += len(texts) - misses
+            self.misses += misses
+
+        if missing:
+            # embed outside of the lock so that concurrent batches overlap on the embedding server
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            for key, vector in zip(missing, vectors):
+                found[key] = vector
+
+        now = time.time()
+        with self._lock:
+            # another batch may have inserted the same text meanwhile; only new rows are counted
+            cursor = self._conn.executemany(
+                "INSERT INTO embeddings (model, key, vector, last_used) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (model, key) DO NOTHING",
+                [(self.model, key, np.asarray(found[key], dtype=np.float32).tobytes(), now) for key in missing],
+            )
+            self._size += cursor.rowcount
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+                [(now, self.model, key) for key in set(keys) if key not in missing],
+            )
+            self._evict()
+            self._conn.commit()
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        # queries are rarely repeated verbatim, so they go straight to the model
+        return self.embeddings.embed_query(text)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": self._size, "max_entries": self.max_entries}
+
+
+embeddings = SQLiteEmbeddingCache(
+    embeddings,
+    model=os.environ["MODEL"],
+    path=os.path.realpath(os.path.join(current_dir, "..", "data", "cache", "embeddings.sqlite")),
 )
-retriever = vectorstore.as_retriever()
+
+# batched, concurrent ingestion: stream chunks from the splitter into the embedder
+import itertools
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, wait
+
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 64))
+EMBED_MAX_IN_FLIGHT = int(os.environ.get("EMBED_MAX_IN_FLIGHT", 4))
+
+
+def ingest_documents(chunks, embeddings, add_batch, batch_size=EMBED_BATCH_SIZE, max_in_flight=EMBED_MAX_IN_FLIGHT):
+    """Embed `chunks` in batches on a thread pool and pass every embedded batch to `add_batch(docs, vectors)`.
+
+    At most `max_in_flight` batches are sent to the embedding server at once, and new batches are
+    pulled from `chunks` (usually a generator over the splitter) only when a slot frees up.
+    Returns throughput statistics.
+    """
+    latencies = []
+    n_chunks = 0
+    start = time.perf_counter()
+
+    def embed(batch):
+        t0 = time.perf_counter()
+        vectors = embeddings.embed_documents([doc.page_content for doc in batch])
+        return batch, vectors, time.perf_counter() - t0
+
+    def collect(futures, return_when):
+        nonlocal n_chunks
+        done, pending = wait(futures, return_when=return_when)
+        for future in done:
+            batch, vectors, latency = future.result()
+            add_batch(list(batch), vectors)
+            latencies.append(latency)
+            n_chunks += len(batch)
+        return pending
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        in_flight = set()
+        for batch in itertools.batched(chunks, batch_size):
+            if len(in_flight) >= max_in_flight:
+                in_flight = collect(in_flight, FIRST_COMPLETED)
+            in_flight.add(pool.submit(embed, batch))
+        collect(in_flight, ALL_COMPLETED)
+
+    elapsed = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if latencies else (0.0, 0.0, 0.0)
+    return {
+        "chunks": n_chunks,
+        "batches": len(latencies),
+        "seconds": elapsed,
+        "chunks_per_sec": n_chunks / elapsed if elapsed else 0.0,
+        "batch_latency_p50": p50,
+        "batch_latency_p95": p95,
+        "batch_latency_p99": p99,
+    }
+
+
+# keep the embeddings in one contiguous float32 matrix instead of InMemoryVectorStore's per-document lists,
+# with a BM25 keyword index next to it and an IVF index over k-means centroids; see rag_index.py
+from rag_index import BM25Index, IVFVectorStore, NumpyVectorStore, SnapshotTexts, benchmark_ivf, tokenize
+
+# rng = np.random.default_rng(0)
+# bench_store = IVFVectorStore(embedding=embeddings)
+# bench_store.add_embeddings([""] * 200_000, rng.normal(size=(200_000, 256)))
+# bench_store.train()
+# benchmark_ivf(bench_store, rng.normal(size=(200, 256)))
+
+# the index is only clustered once the corpus is large enough for the exact scan to be the bottleneck
+IVF_MIN_TRAIN_SIZE = int(os.environ.get("IVF_MIN_TRAIN_SIZE", 100_000))
+
+
+# vector quantization: search compressed codes instead of the float32 rows
+# int8: one byte per dimension, scaled per dimension; the score is codes @ (scale * query)
+# pq: product quantization, the vector is split into `pq_m` subvectors, each replaced by the one-byte id
+# of its nearest centroid in a 256-entry codebook; scores are sums of per-subvector lookup tables computed
+# once per query (asymmetric distance computation: the query itself is not quantized)
+from rag_index import QuantizedVectorStore, benchmark_quantization
+
+# rng = np.random.default_rng(0)
+# benchmark_quantization(rng.normal(size=(200_000, 768)), rng.normal(size=(200, 768)))
+
+# set VECTOR_QUANTIZATION=int8 or pq to quantize the index once it has QUANTIZATION_MIN_TRAIN_SIZE chunks,
+# and QUANTIZED_RERANK_K to rescore that many candidates exactly
+VECTOR_QUANTIZATION = os.environ.get("VECTOR_QUANTIZATION")
+QUANTIZATION_MIN_TRAIN_SIZE = int(os.environ.get("QUANTIZATION_MIN_TRAIN_SIZE", 10_000))
+QUANTIZED_RERANK_K = int(os.environ.get("QUANTIZED_RERANK_K", 0))
+
+
+# incremental re-ingestion: only new or modified chunks are embedded
+from collections import defaultdict
+
+
+def incremental_ingest(store: NumpyVectorStore, docs_list, previous_sources: dict[str, str], unavailable_sources=()):
+    """Bring `store` up to date with `docs_list`.
+
+    `previous_sources` maps every source that was ingested before to the fingerprint of its content.
+    Sources with an unchanged fingerprint are not even split. Chunks of changed sources get
+    content-addressed ids, so a chunk whose text did not change keeps its vector, with its metadata
+    (and so its span) refreshed; chunks that disappeared are deleted. Sources in `unavailable_sources`
+    (e.g. pages that failed to load) keep their chunks. Returns the new source fingerprints and a report of what changed.
+    """
+    ids_by_source = defaultdict(set)
+    for doc_id, metadata in store.metadata_by_id().items():
+        ids_by_source[metadata.get("source", "")].add(doc_id)
+
+    sources = {}
+    changed_docs = []
+    kept = 0
+    for source in unavailable_sources:
+        if source in previous_sources:
+            sources[source] = previous_sources[source]
+            kept += len(ids_by_source[source])
+    for doc in docs_list:
+        source = doc.metadata.get("source", "")
+        sources[source] = fingerprint(source, doc.page_content)
+        if previous_sources.get(source) == sources[source]:
+            kept += len(ids_by_source[source])
+        else:
+            changed_docs.append(doc)
+
+    current_ids = set()
+
+    def new_chunks():
+        nonlocal kept
+        for chunk_id, chunk in with_chunk_ids(iter_splits(changed_docs, text_splitter)):
+            current_ids.add(chunk_id)
+            if chunk_id in store:
+                kept += 1
+                # the text is unchanged but may have moved in its source: keep the span current
+                store.update_metadata([chunk_id], [chunk.metadata])
+            else:
+                chunk.id = chunk_id
+                yield chunk
+
+    def add_batch(batch, vectors):
+        store.add_embeddings(
+            [doc.page_content for doc in batch],
+            vectors,
+            metadatas=[doc.metadata for doc in batch],
+            ids=[doc.id for doc in batch],
+        )
+
+    ingest_stats = ingest_documents(new_chunks(), embeddings, add_batch)
+
+    removed = [
+        doc_id
+        for source, doc_ids in ids_by_source.items()
+        if source not in sources or previous_sources.get(source) != sources[source]
+        for doc_id in doc_ids
+        if doc_id not in current_ids
+    ]
+    store.delete(removed)
+    report = {
+        "added": ingest_stats["chunks"],
+        "removed": len(removed),
+        "kept": kept,
+        "embedding_calls": ingest_stats["batches"],
+        **ingest_stats,
+    }
+    return sources, report
+
+
+# load the index from its snapshot when it was built with the same model and chunking, otherwise rebuild it
+index_dir = os.path.realpath(os.path.join(current_dir, "..", "data", "cache", "index"))
+index_config = {
+    "model": os.environ["MODEL"],
+    "splitter": type(text_splitter).__name__,
+    "chunk_size": CHUNK_SIZE,
+    "chunk_overlap": CHUNK_OVERLAP,
+    # snapshots whose chunks carry the start_index of add_start_index are rebuilt with the real spans
+    "chunk_spans": 2,
+}
+try:
+    start = time.perf_counter()
+    vectorstore = QuantizedVectorStore.load_snapshot(index_dir, embeddings, index_config, rerank_k=QUANTIZED_RERANK_K)
+    if vectorstore.keyword_index is None:
+        # snapshots written before the keyword index existed
+        vectorstore.keyword_index = BM25Index()
+        vectorstore.keyword_index.add(vectorstore._ids, vectorstore._texts)
+    print(
+        f"Loaded index snapshot {vectorstore.manifest['version']} "
+        f"({len(vectorstore)} chunks) in {time.perf_counter() - start:.3f}s"
+    )
+except (FileNotFoundError, ValueError) as e:
+    print(f"Building a new index snapshot: {e}")
+    vectorstore = None
+
+# set REINDEX=1 to refresh an existing snapshot from the current contents of `urls`
+if vectorstore is None or os.environ.get("REINDEX") == "1":
+    previous_sources = vectorstore.manifest.get("sources", {}) if vectorstore is not None else {}
+    if vectorstore is None:
+        vectorstore = QuantizedVectorStore(
+            embedding=embeddings, keyword_index=BM25Index(), quantization=VECTOR_QUANTIZATION, rerank_k=QUANTIZED_RERANK_K
+        )
+    sources, report = incremental_ingest(vectorstore, load_documents(urls), previous_sources, loader.failed)
+    print(
+        f"Ingestion: {report['added']} added, {report['removed']} removed, {report['kept']} kept, "
+        f"{report['embedding_calls']} embedding calls ({report['chunks_per_sec']:.1f} chunks/s, batch latency "
+        f"p50={report['batch_latency_p50']:.3f}s p95={report['batch_latency_p95']:.3f}s "
+        f"p99={report['batch_latency_p99']:.3f}s)"
+    )
+    if not vectorstore.is_trained and len(vectorstore) >= IVF_MIN_TRAIN_SIZE:
+        vectorstore.train()
+    if VECTOR_QUANTIZATION and not vectorstore.is_quantized and len(vectorstore) >= QUANTIZATION_MIN_TRAIN_SIZE:
+        vectorstore.train_quantizer(VECTOR_QUANTIZATION)
+    if report["added"] or report["removed"] or sources != previous_sources:
+        vectorstore.save_snapshot(index_dir, {**index_config, "sources": sources})
+
+
+# hybrid retrieval: fuse the dense and the BM25 rankings with reciprocal-rank fusion
+from rag_index import HybridRetriever, reciprocal_rank_fusion
+
+
+# rerank: over-fetch RERANK_FETCH_K candidates and keep the RERANK_TOP_K best according to a reranker model
+# the stage is only added to the graph when RERANK_MODEL is set
+from rag_index import OllamaReranker
+
+RERANK_MODEL = os.environ.get("RERANK_MODEL")
+RERANK_FETCH_K = int(os.environ.get("RERANK_FETCH_K", 20))
+RERANK_TOP_K = int(os.environ.get("RERANK_TOP_K", 4))
+
+RETRIEVE_K = RERANK_FETCH_K if RERANK_MODEL else 4
+
+retriever = HybridRetriever(vectorstore=vectorstore, k=RETRIEVE_K)
+print(f"Embedding cache: {embeddings.stats()}")
 
 from langchain.tools.retriever import create_retriever_tool
 
+# the retrieved documents are kept as the ToolMessage artifact so that they can be graded one by one
 retriever_tool = create_retriever_tool(
     retriever,
     "retrieve_blog_posts",
     "Search and return information about Lilian Weng blog posts.",
+    response_format="content_and_artifact",
 )
 
 # results = retriever_tool.invoke({"query": "types of reward hacking"})
@@ -64,16 +452,345 @@ retriever_tool = create_retriever_tool(
 # from pprint import pprint
 # pprint(results)
 
+
+# multi-tenant collections: every collection is its own index shard, with its own snapshot directory
+# under data/cache/collections/<name>. Shards are memory-mapped on their first query and the least recently
+# used ones are dropped once the loaded shards exceed the memory budget, so memory per worker stays bounded
+# however many collections exist
+from collections import OrderedDict
+
+COLLECTIONS_DIR = os.path.realpath(os.path.join(current_dir, "..", "data", "cache", "collections"))
+COLLECTION_MEMORY_BUDGET = int(os.environ.get("COLLECTION_MEMORY_BUDGET_MB", 1024)) * 2**20
+# the collection built above from `urls`
+DEFAULT_COLLECTION = "blog_posts"
+
+
+def deep_nbytes(value, sample_size: int = 256) -> int:
+    """Approximate bytes held by `value`: NumPy arrays and memory maps, strings, `array`s and the containers
+    holding them, and the attributes of the index objects. Large containers are estimated from a sample.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (BM25Index, SnapshotTexts)):
+        return deep_nbytes(vars(value), sample_size)
+    if isinstance(value, dict):
+        items = list(itertools.islice(value.items(), sample_size)) if len(value) > sample_size else list(value.items())
+        sampled = sum(deep_nbytes(key, sample_size) + deep_nbytes(item, sample_size) for key, item in items)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        if isinstance(value, (list, tuple)):
+            items = [value[i] for i in np.linspace(0, len(value) - 1, min(len(value), sample_size)).astype(int)]
+        else:
+            items = list(itertools.islice(value, sample_size))
+        sampled = sum(deep_nbytes(item, sample_size) for item in items)
+    else:
+        return sys.getsizeof(value)
+    return sys.getsizeof(value) + (sampled * len(value) // len(items) if items else 0)
+
+
+def shard_nbytes(store: NumpyVectorStore) -> int:
+    """Approximate memory of a shard: its vectors and codes, ids, texts, metadata, IVF lists and keyword index."""
+    return sum(deep_nbytes(value) for name, value in vars(store).items() if name != "embedding")
+
+
+class CollectionRegistry:
+    """Index shards by collection name, loaded lazily and evicted least recently used.
+
+    A collection is either registered with an explicit snapshot directory, or found as a snapshot
+    directory under `root`. Snapshots are checked against `expected` like at startup.
+    """
+
+    def __init__(self, root: str, embedding: Embeddings, expected: dict, memory_budget: int = COLLECTION_MEMORY_BUDGET):
+        self.root = root
+        self.embedding = embedding
+        self.expected = expected
+        self.memory_budget = memory_budget
+        self.stats = Counter()
+        self._directories: dict[str, str] = {}
+        self._shards: OrderedDict[str, NumpyVectorStore] = OrderedDict()
+        self._nbytes: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, directory: str, store: Optional[NumpyVectorStore] = None):
+        """Register a collection stored under `directory`, optionally with its already loaded shard."""
+        with self._lock:
+            self._directories[name] = directory
+            if store is not None:
+                self._insert(name, store)
+
+    def directory(self, name: str) -> str:
+        return self._directories.get(name) or os.path.join(self.root, name)
+
+    def names(self) -> list[str]:
+        found = set(self._directories)
+        if os.path.isdir(self.root):
+            found.update(
+                name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, "CURRENT"))
+            )
+        return sorted(found)
+
+    def save(self, name: str, store: NumpyVectorStore, manifest: dict):
+        """Write `store` as the new snapshot of collection `name`; the next query loads it."""
+        store.save_snapshot(self.directory(name), {**self.expected, **manifest})
+        with self._lock:
+            if name in self._shards:
+                self._shards.pop(name)
+                self._nbytes.pop(name)
+
+    def get(self, name: str) -> NumpyVectorStore:
+        """The shard of collection `name`, loading it on first use. Raises KeyError for unknown collections."""
+        with self._lock:
+            if name in self._shards:
+                self._shards.move_to_end(name)
+                self.stats["hits"] += 1
+                return self._shards[name]
+
+        directory = self.directory(name)
+        if not os.path.exists(os.path.join(directory, "CURRENT")):
+            raise KeyError(f"Unknown collection: {name}")
+        start = time.perf_counter()
+        store = QuantizedVectorStore.load_snapshot(directory, self.embedding, self.expected, rerank_k=QUANTIZED_RERANK_K)
+
+        with self._lock:
+            # another thread may have loaded it meanwhile
+            if name in self._shards:
+                return self._shards[name]
+            self.stats["loads"] += 1
+            self.stats["load_seconds"] += time.perf_counter() - start
+            self._insert(name, store)
+            return store
+
+    def _insert(self, name: str, store: NumpyVectorStore):
+        self._shards[name] = store
+        self._nbytes[name] = shard_nbytes(store)
+        # the shard just inserted is kept even when it alone exceeds the budget
+        while len(self._shards) > 1 and self.memory_used() > self.memory_budget:
+            evicted, _ = self._shards.popitem(last=False)
+            self._nbytes.pop(evicted)
+            self.stats["evictions"] += 1
+
+    def memory_used(self) -> int:
+        return sum(self._nbytes.values())
+
+    def search(self, names: list[str], query: str, k: int) -> list[Document]:
+        """Top-k documents for the query across the collections in `names`.
+
+        A single collection is searched with HybridRetriever. Several collections are searched concurrently,
+        and their candidates are merged into two global rankings fused with reciprocal-rank fusion like
+        HybridRetriever does: by cosine similarity to one query embedding, comparable across shards built with
+        the same embedding model, and by BM25 scored with the term statistics of all the shards together.
+        """
+        if len(names) == 1:
+            docs = HybridRetriever(vectorstore=self.get(names[0]), k=k).invoke(query)
+            return [Document(page_content=doc.page_content, metadata={**doc.metadata, "collection": names[0]}, id=doc.id) for doc in docs]
+
+        hybrid = HybridRetriever.model_fields
+        fetch_k, rrf_k = hybrid["fetch_k"].default, hybrid["rrf_k"].default
+        vector = self.embedding.embed_query(query)
+        with ThreadPoolExecutor(max_workers=min(len(names), 8)) as pool:
+            stores = dict(zip(names, pool.map(self.get, names)))
+            keyword_indexes = {name: store.keyword_index for name, store in stores.items() if store.keyword_index is not None}
+            stats = {"n_docs": 0, "total_len": 0, "df": Counter()}
+            for shard_stats in pool.map(lambda index: index.term_stats(query), keyword_indexes.values()):
+                stats["n_docs"] += shard_stats["n_docs"]
+                stats["total_len"] += shard_stats["total_len"]
+                stats["df"].update(shard_stats["df"])
+
+            def dense(name):
+                return [(score, (name, doc.id)) for doc, score in stores[name].similarity_search_with_score_by_vector(vector, k=fetch_k)]
+
+            def keyword(name):
+                return [(score, (name, doc_id)) for doc_id, score in keyword_indexes[name].search(query, fetch_k, stats)]
+
+            rankings = [
+                [key for _, key in sorted((hit for hits in pool.map(search, shards) for hit in hits), key=lambda hit: -hit[0])]
+                for search, shards in ((dense, names), (keyword, list(keyword_indexes)))
+            ]
+        return [
+            Document(page_content=doc.page_content, metadata={**doc.metadata, "collection": name}, id=doc.id)
+            for name, doc_id in reciprocal_rank_fusion(rankings, rrf_k)[:k]
+            for doc in stores[name].get_by_ids([doc_id])
+        ]
+
+
+collection_registry = CollectionRegistry(COLLECTIONS_DIR, embeddings, index_config)
+collection_registry.register(DEFAULT_COLLECTION, index_dir, vectorstore)
+# from here on the registry owns the default shard; module-level references would keep it loaded after eviction
+del vectorstore, retriever, retriever_tool
+
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import tool
+
+
+def collections_of(config: RunnableConfig) -> list[str]:
+    """Collections to search, from `collections` in the graph config (a name or a list of names)."""
+    names = config.get("configurable", {}).get("collections", DEFAULT_COLLECTION)
+    if isinstance(names, str):
+        names = [names]
+    return sorted(set(names))
+
+
+# routes to the collections of the graph config; replaces the single-collection tool above
+@tool("retrieve_blog_posts", response_format="content_and_artifact")
+def retriever_tool(query: str, config: RunnableConfig) -> tuple[str, list[Document]]:
+    """Search and return information about Lilian Weng blog posts."""
+    docs = collection_registry.search(collections_of(config), query, RETRIEVE_K)
+    return "\n\n".join(doc.page_content for doc in docs), docs
+
+# add a collection: build its shard like the default one and save it to the registry
+# papers = QuantizedVectorStore(embedding=embeddings, keyword_index=BM25Index())
+# paper_sources, _ = incremental_ingest(papers, load_documents(["https://arxiv.org/abs/2201.03544"]), {})
+# collection_registry.save("papers", papers, {"sources": paper_sources})
+
+# search one collection, or fan out over several, through the graph config
+# results = retriever_tool.invoke({"query": "types of reward hacking"}, {"configurable": {"collections": ["blog_posts", "papers"]}})
+
+
+
+# semantic response cache: answer repeated questions without running the graph
+from dataclasses import dataclass
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    vector: np.ndarray
+    created_at: float
+    latency: float
+
+
+class SemanticCache:
+    """Cache of answers keyed by the embedding of the question.
+
+    A question hits the cache when an entry younger than `ttl` seconds has a cosine similarity of at
+    least `threshold` with it. At most `max_entries` answers are kept, evicting the least recently used.
+    All entries are dropped when `invalidate` is called with a new index snapshot version.
+    """
+
+    def __init__(self, embeddings: Embeddings, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 1024):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._entries: OrderedDict[str, CachedAnswer] = OrderedDict()
+        # questions looked up but not answered yet; runs that fail never `put`, so it is bounded like the entries
+        self._pending: OrderedDict[str, tuple[float, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self, version: str):
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def lookup(self, question: str) -> Optional[str]:
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl]:
+                del self._entries[key]
+            if self._entries:
+                keys = list(self._entries)
+                scores = np.stack([self._entries[key].vector for key in keys]) @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    entry = self._entries[keys[best]]
+                    self._entries.move_to_end(keys[best])
+                    self.hits += 1
+                    self.saved_seconds += entry.latency
+                    return entry.answer
+            self.misses += 1
+            # remember when the miss happened, so `put` can record how long the uncached answer took
+            self._pending[question] = (time.perf_counter(), vector)
+            self._pending.move_to_end(question)
+            while len(self._pending) > self.max_entries:
+                self._pending.popitem(last=False)
+            return None
+
+    def put(self, question: str, answer: str):
+        with self._lock:
+            if question not in self._pending:
+                return
+            started_at, vector = self._pending.pop(question)
+            self._entries[question] = CachedAnswer(
+                question, answer, vector, time.time(), time.perf_counter() - started_at
+            )
+            self._entries.move_to_end(question)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_seconds": self.saved_seconds,
+            "size": len(self._entries),
+        }
+
+
+semantic_cache = SemanticCache(
+    embeddings,
+    threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+    ttl=float(os.environ.get("SEMANTIC_CACHE_TTL", 3600)),
+)
+# answers are only shared between requests that search the same collections. Every cache can grow to
+# max_entries answers, so caches are kept for at most SEMANTIC_CACHE_TOTAL_ENTRIES // max_entries collection
+# sets, dropping the least recently used one, and memory per worker stays bounded however many sets are queried
+SEMANTIC_CACHE_TOTAL_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_TOTAL_ENTRIES", 8192))
+semantic_caches: OrderedDict[str, SemanticCache] = OrderedDict({DEFAULT_COLLECTION: semantic_cache})
+semantic_caches_lock = threading.Lock()
+
+
+def semantic_cache_for(config: RunnableConfig) -> SemanticCache:
+    key = "+".join(collections_of(config))
+    with semantic_caches_lock:
+        if key not in semantic_caches:
+            semantic_caches[key] = SemanticCache(
+                embeddings, threshold=semantic_cache.threshold, ttl=semantic_cache.ttl, max_entries=semantic_cache.max_entries
+            )
+        semantic_caches.move_to_end(key)
+        max_caches = max(1, SEMANTIC_CACHE_TOTAL_ENTRIES // semantic_cache.max_entries)
+        while len(semantic_caches) > max_caches:
+            semantic_caches.popitem(last=False)
+        return semantic_caches[key]
+
 # generate query
 from langgraph.graph import MessagesState
 from langchain_ollama import ChatOllama
 
+
+class AgentState(MessagesState):
+    # fingerprints of the rewritten questions and of the retrieved document sets seen in this run
+    rewrite_fingerprints: list[str]
+    retrieval_fingerprints: list[str]
+    rewrites: int
+    # relevance of each chunk of the last retrieval, and the chunks that passed the grader
+    relevance: list[bool]
+    relevant_documents: list[Document]
+    # set when rewriting stopped early, so that generate_answer uses the best context gathered so far
+    stop_rewriting: bool
+    cycles_avoided: int
+    # tokens saved by compressing the context of generate_answer
+    compression: dict
+
+
 response_model = ChatOllama(
     model=os.environ["MODEL"],
     temperature=0,
 )
 
-def generate_query_or_respond(state: MessagesState):
+def generate_query_or_respond(state: MessagesState, config: RunnableConfig):
     """Call the model to generate a response based on the current state. Given
     the question, it will decide to retrieve using the retriever tool, or simply respond to the user.
     """
@@ -81,10 +798,12 @@ def generate_query_or_respond(state: MessagesState):
         response_model
         .bind_tools([retriever_tool]).invoke(state["messages"])
     )
+    if not response.tool_calls:
+        semantic_cache_for(config).put(state["messages"][0].content, response.content)
     return {"messages": [response]}
 
 # input = {"messages": [{"role": "user", "content": "Hello!"}]}
-# generate_query_or_respond(input)["messages"][-1].pretty_print()
+# generate_query_or_respond(input, {})["messages"][-1].pretty_print()
 
 # input = {
 #     "messages": [
@@ -94,9 +813,10 @@ def generate_query_or_respond(state: MessagesState):
 #         }
 #     ]
 # }
-# generate_query_or_respond(input)["messages"][-1].pretty_print()
+# generate_query_or_respond(input, {})["messages"][-1].pretty_print()
 
 # grade documents: whether the retrieved documents are relevant
+from langchain_core.messages import ToolMessage
 from pydantic import BaseModel, Field
 from typing import Literal
 
@@ -122,24 +842,100 @@ grader_model = ChatOllama(
     temperature=0,
 )
 
+# grade every retrieved chunk in one call, so that relevant chunks are kept even when others are not
+GRADE_BATCH_PROMPT = (
+    "You are a grader assessing relevance of retrieved documents to a user question. \n "
+    "Here are the retrieved documents, numbered: \n\n {documents} \n\n"
+    "Here is the user question: {question} \n"
+    "For each document, if it contains keyword(s) or semantic meaning related to the user question, grade it as relevant. \n"
+    "Give one binary score 'yes' or 'no' per document, in the same order as the documents."
+)
 
-def grade_documents(
-    state: MessagesState,
-) -> Literal["generate_answer", "rewrite_question"]:
-    """Determine whether the retrieved documents are relevant to the question."""
-    question = state["messages"][0].content
-    context = state["messages"][-1].content
 
-    prompt = GRADE_PROMPT.format(question=question, context=context)
-    response = (
-        grader_model
-        .with_structured_output(GradeDocuments).invoke(
-            [{"role": "user", "content": prompt}]
-        )
+class GradeDocumentsBatch(BaseModel):
+    """Grade each retrieved document using a binary score for relevance check."""
+
+    binary_scores: list[str] = Field(
+        description="One relevance score per document, in order: 'yes' if relevant, or 'no' if not relevant"
     )
-    score = response.binary_score
 
-    if score == "yes":
+
+GRADE_MAX_CONCURRENCY = int(os.environ.get("GRADE_MAX_CONCURRENCY", 4))
+
+# structured output is streamed as JSON text, so the internal models are tagged to keep it out of the token stream
+batch_grader = grader_model.with_structured_output(GradeDocumentsBatch).with_config(tags=["nostream"])
+single_grader = grader_model.with_structured_output(GradeDocuments).with_config(tags=["nostream"])
+
+
+def grade_batch_input(question: str, docs: list[Document]) -> list[dict]:
+    documents = "\n\n".join(f"Document {i}: {doc.page_content}" for i, doc in enumerate(docs, start=1))
+    return [{"role": "user", "content": GRADE_BATCH_PROMPT.format(question=question, documents=documents)}]
+
+
+def grade_single_inputs(question: str, docs: list[Document]) -> list[list[dict]]:
+    return [
+        [{"role": "user", "content": GRADE_PROMPT.format(question=question, context=doc.page_content)}]
+        for doc in docs
+    ]
+
+
+def grade_chunks(question: str, docs: list[Document]) -> list[bool]:
+    """Return the relevance of each document to the question."""
+    if not docs:
+        return []
+    response = batch_grader.invoke(grade_batch_input(question, docs))
+    scores = response.binary_scores
+    if len(scores) != len(docs):
+        # the model did not return one score per document, so grade them separately with bounded concurrency
+        responses = single_grader.batch(
+            grade_single_inputs(question, docs),
+            config={"max_concurrency": GRADE_MAX_CONCURRENCY},
+        )
+        scores = [response.binary_score for response in responses]
+    return [score.strip().lower() == "yes" for score in scores]
+
+
+def last_retrieval(state: AgentState) -> tuple[list[ToolMessage], list[Document]]:
+    """The tool messages of the last retrieve step and their documents.
+
+    In multi-query mode one step answers several queries concurrently; their rankings are merged
+    with reciprocal-rank fusion, like the dense and keyword rankings of HybridRetriever.
+    """
+    messages = []
+    for message in reversed(state["messages"]):
+        if not isinstance(message, ToolMessage):
+            break
+        messages.insert(0, message)
+    if not messages:
+        message = state["messages"][-1]
+        return [], [Document(page_content=message.content)]
+    if len(messages) == 1:
+        return messages, messages[0].artifact or [Document(page_content=messages[0].content)]
+
+    fused, docs = defaultdict(float), {}
+    for message in messages:
+        # messages emptied by the rerank node have an empty artifact
+        results = message.artifact if message.artifact is not None else [Document(page_content=message.content)]
+        for rank, doc in enumerate(results, start=1):
+            key = doc.id or text_fingerprint(doc.page_content)
+            fused[key] += 1 / (HybridRetriever.model_fields["rrf_k"].default + rank)
+            docs.setdefault(key, doc)
+    return messages, [docs[key] for key in sorted(fused, key=fused.get, reverse=True)]
+
+
+def grade_documents(state: AgentState):
+    """Determine which of the retrieved documents are relevant to the question."""
+    question = state["messages"][0].content
+    _, docs = last_retrieval(state)
+    relevance = grade_chunks(question, docs)
+    return {
+        "relevance": relevance,
+        "relevant_documents": [doc for doc, relevant in zip(docs, relevance) if relevant],
+    }
+
+
+def route_grading(state: AgentState) -> Literal["generate_answer", "rewrite_question"]:
+    if state.get("relevant_documents"):
         return "generate_answer"
     else:
         return "rewrite_question"
@@ -185,13 +981,134 @@ REWRITE_PROMPT = (
 )
 
 
-def rewrite_question(state: MessagesState):
-    """Rewrite the original user question."""
-    messages = state["messages"]
-    question = messages[0].content
-    prompt = REWRITE_PROMPT.format(question=question)
-    response = response_model.invoke([{"role": "user", "content": prompt}])
-    return {"messages": convert_to_messages([{"role": "user", "content": response.content}])}
+# stop the rewrite loop once it stops making progress
+from langchain_core.messages import AIMessage
+
+MAX_REWRITES = int(os.environ.get("MAX_REWRITES", 3))
+# totals over all runs of this process; per-run counts are kept in AgentState
+loop_stats = Counter()
+
+
+def text_fingerprint(text: str) -> str:
+    """Fingerprint that ignores case, punctuation and whitespace."""
+    return fingerprint(" ".join(tokenize(text)))
+
+
+# multi-query mode: each rewrite produces `num_queries` reformulations (graph config, default NUM_QUERIES),
+# which are sent to the retriever as parallel tool calls and merged by last_retrieval
+NUM_QUERIES = int(os.environ.get("NUM_QUERIES", 1))
+
+MULTI_QUERY_PROMPT = (
+    "Look at the input and try to reason about the underlying semantic intent / meaning.\n"
+    "Here is the initial question:"
+    "\n ------- \n"
+    "{question}"
+    "\n ------- \n"
+    "Formulate {num_queries} different improved search queries for it:"
+)
+
+
+class RewriteQueries(BaseModel):
+    """Several reformulations of a question."""
+
+    queries: list[str] = Field(description="Improved search queries, each phrased differently")
+
+
+query_rewriter = response_model.with_config(tags=["nostream"])
+multi_query_rewriter = response_model.with_structured_output(RewriteQueries).with_config(tags=["nostream"])
+
+
+def rewrite_stop_reason(state: AgentState, config: RunnableConfig) -> Optional[str]:
+    """Why rewriting should stop before calling the model, if it should."""
+    max_rewrites = config.get("configurable", {}).get("max_rewrites", MAX_REWRITES)
+    if retrieval_fingerprint(state) in state.get("retrieval_fingerprints", []):
+        return "repeated_retrievals"
+    if state.get("rewrites", 0) >= max_rewrites:
+        return "rewrite_budget_exhausted"
+    return None
+
+
+def retrieval_fingerprint(state: AgentState) -> str:
+    messages, docs = last_retrieval(state)
+    return text_fingerprint("\n\n".join(message.content for message in messages) or docs[0].page_content)
+
+
+def rewrite_prompt(state: AgentState, config: RunnableConfig) -> tuple[int, str]:
+    question = state["messages"][0].content
+    num_queries = config.get("configurable", {}).get("num_queries", NUM_QUERIES)
+    if num_queries > 1:
+        return num_queries, MULTI_QUERY_PROMPT.format(question=question, num_queries=num_queries)
+    return num_queries, REWRITE_PROMPT.format(question=question)
+
+
+def rewrite_update(state: AgentState, stop: Optional[str], queries: list[str]) -> dict:
+    """State update of rewrite_question for the given reformulations, or for stopping with `stop`."""
+    rewrite_fingerprints = state.get("rewrite_fingerprints") or [text_fingerprint(state["messages"][0].content)]
+    retrieval_fingerprints = state.get("retrieval_fingerprints", []) + [retrieval_fingerprint(state)]
+
+    new_queries = {}
+    for query in queries:
+        key = text_fingerprint(query)
+        if key not in rewrite_fingerprints:
+            new_queries.setdefault(key, query)
+    if stop is None and not new_queries:
+        stop = "repeated_rewrites"
+
+    if stop is not None:
+        loop_stats[stop] += 1
+        loop_stats["cycles_avoided"] += 1
+        return {
+            "stop_rewriting": True,
+            "cycles_avoided": state.get("cycles_avoided", 0) + 1,
+            "retrieval_fingerprints": retrieval_fingerprints,
+        }
+    if len(queries) == 1:
+        # let generate_query_or_respond decide how to search for the rewritten question
+        messages = convert_to_messages([{"role": "user", "content": queries[0]}])
+    else:
+        # search for all new reformulations at once, the retrieve node runs the tool calls concurrently
+        messages = [
+            AIMessage(
+                content="",
+                tool_calls=[
+                    {"name": retriever_tool.name, "args": {"query": query}, "id": f"rewrite_{key[:16]}"}
+                    for key, query in new_queries.items()
+                ],
+            )
+        ]
+    return {
+        "messages": messages,
+        "rewrite_fingerprints": rewrite_fingerprints + list(new_queries),
+        "retrieval_fingerprints": retrieval_fingerprints,
+        "rewrites": state.get("rewrites", 0) + 1,
+    }
+
+
+def rewrite_question(state: AgentState, config: RunnableConfig):
+    """Rewrite the original user question.
+
+    Rewriting stops, and the graph moves on to generate_answer, when the last retrieval returned a
+    document set that was already retrieved in this run, when the rewrite repeats an earlier question,
+    or when `max_rewrites` (graph config, default MAX_REWRITES) rewrites were made.
+    """
+    stop = rewrite_stop_reason(state, config)
+    queries = []
+    if stop is None:
+        num_queries, prompt = rewrite_prompt(state, config)
+        if num_queries > 1:
+            response = multi_query_rewriter.invoke([{"role": "user", "content": prompt}])
+            queries = response.queries[:num_queries]
+        else:
+            queries = [query_rewriter.invoke([{"role": "user", "content": prompt}]).content]
+    return rewrite_update(state, stop, queries)
+
+
+def route_rewrite(state: AgentState) -> Literal["generate_query_or_respond", "retrieve", "generate_answer"]:
+    if state.get("stop_rewriting"):
+        return "generate_answer"
+    if getattr(state["messages"][-1], "tool_calls", None):
+        return "retrieve"
+    return "generate_query_or_respond"
 
 # input = {
 #     "messages": convert_to_messages(
@@ -231,13 +1148,111 @@ GENERATE_PROMPT = (
 )
 
 
-def generate_answer(state: MessagesState):
-    """Generate an answer."""
+def retrieved_documents(state: AgentState) -> list[Document]:
+    """All distinct documents retrieved in this run, oldest first."""
+    seen, docs = set(), []
+    for message in state["messages"]:
+        if not isinstance(message, ToolMessage):
+            continue
+        for doc in message.artifact if message.artifact is not None else [Document(page_content=message.content)]:
+            key = doc.id or text_fingerprint(doc.page_content)
+            if key not in seen:
+                seen.add(key)
+                docs.append(doc)
+    return docs
+
+
+# context compression: prompt tokens, and with them latency, grow with the retrieved context
+# chunks below CONTEXT_SIMILARITY_THRESHOLD cosine similarity to the question are dropped, the most similar
+# remaining ones are kept while the context fits `context_token_budget` (graph config, default
+# CONTEXT_TOKEN_BUDGET), and overlapping and adjacent kept chunks of a source are merged into passages, so that
+# the overlap is sent once. Chunks are scored with the vectors already in their shard, so that compression adds
+# no embedding call for them on the way to generate_answer; only the question (and chunks that are not in a
+# shard) go through the embedding cache
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1024))
+CONTEXT_SIMILARITY_THRESHOLD = float(os.environ.get("CONTEXT_SIMILARITY_THRESHOLD", 0.5))
+# totals over all requests of this process; each request's report is kept in AgentState
+compression_stats = Counter()
+
+from rag_index import merge_chunks
+
+
+def stored_vectors(docs: list[Document]) -> dict[str, np.ndarray]:
+    """Vectors of the retrieved chunks, by id, read from the shard of their collection."""
+    ids_by_collection = defaultdict(list)
+    for doc in docs:
+        if doc.id is not None and "collection" in doc.metadata:
+            ids_by_collection[doc.metadata["collection"]].append(doc.id)
+    vectors = {}
+    for name, ids in ids_by_collection.items():
+        try:
+            vectors.update(collection_registry.get(name).vectors_by_ids(ids))
+        except KeyError:
+            continue
+    return vectors
+
+
+def compress_context(question: str, docs: list[Document], token_budget: int = CONTEXT_TOKEN_BUDGET) -> tuple[str, dict]:
+    """Return the compressed context for the question and a report of the tokens it saved.
+
+    The budget is checked on the context as it is sent, separators included. When no chunk reaches the
+    similarity threshold, the most similar ones are kept within the budget.
+    """
+    raw = "\n\n".join(doc.page_content for doc in docs)
+    kept, passages = [], []
+    if docs:
+        stored = stored_vectors(docs)
+        missing = [doc.page_content for doc in docs if doc.id not in stored]
+        computed = iter(embeddings.embed_documents([question] + missing))
+        query = np.asarray(next(computed), dtype=np.float32)
+        vectors = np.asarray(
+            [stored[doc.id] if doc.id in stored else next(computed) for doc in docs], dtype=np.float32
+        )
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        similarity = vectors @ (query / max(float(np.linalg.norm(query)), 1e-12))
+        order = np.argsort(-similarity, kind="stable")
+        candidates = [n for n in order if similarity[n] >= CONTEXT_SIMILARITY_THRESHOLD] or list(order)
+        for n in candidates:
+            # in retrieval order, so that passages keep the rank of their best chunk
+            trial = merge_chunks([docs[i] for i in sorted(kept + [n])])
+            if text_splitter.token_count("\n\n".join(trial)) <= token_budget:
+                kept.append(n)
+                passages = trial
+    context = "\n\n".join(passages)
+
+    report = {
+        "chunks": len(docs),
+        "kept_chunks": len(kept),
+        "passages": len(passages),
+        "tokens_before": text_splitter.token_count(raw),
+        "tokens_after": text_splitter.token_count(context),
+    }
+    report["tokens_saved"] = report["tokens_before"] - report["tokens_after"]
+    for key, value in report.items():
+        compression_stats[key] += value
+    compression_stats["requests"] += 1
+    return context, report
+
+
+def answer_prompt(state: AgentState, config: RunnableConfig) -> tuple[str, dict]:
     question = state["messages"][0].content
-    context = state["messages"][-1].content
-    prompt = GENERATE_PROMPT.format(question=question, context=context)
+    # only the chunks that passed the grader are used; when rewriting was cut short none did,
+    # so everything retrieved in this run is used instead
+    if state.get("relevant_documents") and not state.get("stop_rewriting"):
+        docs = state["relevant_documents"]
+    else:
+        docs = retrieved_documents(state)
+    token_budget = config.get("configurable", {}).get("context_token_budget", CONTEXT_TOKEN_BUDGET)
+    context, report = compress_context(question, docs, token_budget)
+    return GENERATE_PROMPT.format(question=question, context=context), report
+
+
+def generate_answer(state: AgentState, config: RunnableConfig):
+    """Generate an answer."""
+    prompt, compression = answer_prompt(state, config)
     response = response_model.invoke([{"role": "user", "content": prompt}])
-    return {"messages": [response]}
+    semantic_cache_for(config).put(state["messages"][0].content, response.content)
+    return {"messages": [response], "compression": compression}
 
 # input = {
 #     "messages": convert_to_messages(
@@ -266,48 +1281,203 @@ def generate_answer(state: MessagesState):
 #     )
 # }
 
-# response = generate_answer(input)
+# response = generate_answer(input, {})
 # response["messages"][-1].pretty_print()
 
 
-# assemble the graph
+# rerank the retrieved chunks before they are graded
+reranker = OllamaReranker(RERANK_MODEL, base_url=os.environ.get("OLLAMA_HOST", "http://localhost:11434")) if RERANK_MODEL else None
+# rerank time against the context tokens it removed from the grading and generation prompts
+rerank_stats = Counter()
+
+
+def rerank(state: AgentState, config: RunnableConfig):
+    """Keep the `rerank_top_k` (graph config, default RERANK_TOP_K) chunks that the reranker scores highest."""
+    top_k = config.get("configurable", {}).get("rerank_top_k", RERANK_TOP_K)
+    question = state["messages"][0].content
+    messages, docs = last_retrieval(state)
+
+    start = time.perf_counter()
+    scores = reranker.score(question, docs)
+    kept = [docs[i] for i in sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)[:top_k]]
+    rerank_stats["runs"] += 1
+    rerank_stats["seconds"] += time.perf_counter() - start
+    rerank_stats["tokens_before"] += sum(text_splitter.token_count(doc.page_content) for doc in docs)
+    rerank_stats["tokens_after"] += sum(text_splitter.token_count(doc.page_content) for doc in kept)
+
+    # same ids, so the reranked messages replace the retrieval results in the state;
+    # results of several queries are merged into the first message
+    return {
+        "messages": [
+            ToolMessage(
+                content="\n\n".join(doc.page_content for doc in kept) if i == 0 else "",
+                artifact=kept if i == 0 else [],
+                tool_call_id=message.tool_call_id,
+                name=message.name,
+                id=message.id,
+            )
+            for i, message in enumerate(messages)
+        ]
+    }
+
+
+# look up the question in the semantic cache before running any LLM call
 from langgraph.graph import StateGraph, START, END
+
+
+def check_cache(state: MessagesState, config: RunnableConfig):
+    """Answer from the semantic cache when a similar question was answered before."""
+    cache = semantic_cache_for(config)
+    cache.invalidate("+".join(
+        str(collection_registry.get(name).manifest.get("version")) for name in collections_of(config)
+    ))
+    answer = cache.lookup(state["messages"][0].content)
+    if answer is None:
+        return {"messages": []}
+    return {"messages": [AIMessage(content=answer)]}
+
+
+def route_cache(state: MessagesState) -> Literal["generate_query_or_respond", END]:
+    if isinstance(state["messages"][-1], AIMessage):
+        return END
+    return "generate_query_or_respond"
+
+
+# async-native nodes: the same steps with `ainvoke`, so that one worker thread serves many conversations
+# the retriever and the reranker are CPU bound or use blocking clients, and run in worker threads
+import asyncio
+
+
+async def agenerate_query_or_respond(state: MessagesState, config: RunnableConfig):
+    response = await response_model.bind_tools([retriever_tool]).ainvoke(state["messages"])
+    if not response.tool_calls:
+        semantic_cache_for(config).put(state["messages"][0].content, response.content)
+    return {"messages": [response]}
+
+
+async def agrade_chunks(question: str, docs: list[Document]) -> list[bool]:
+    if not docs:
+        return []
+    response = await batch_grader.ainvoke(grade_batch_input(question, docs))
+    scores = response.binary_scores
+    if len(scores) != len(docs):
+        responses = await single_grader.abatch(
+            grade_single_inputs(question, docs),
+            config={"max_concurrency": GRADE_MAX_CONCURRENCY},
+        )
+        scores = [response.binary_score for response in responses]
+    return [score.strip().lower() == "yes" for score in scores]
+
+
+async def agrade_documents(state: AgentState):
+    question = state["messages"][0].content
+    _, docs = last_retrieval(state)
+    relevance = await agrade_chunks(question, docs)
+    return {
+        "relevance": relevance,
+        "relevant_documents": [doc for doc, relevant in zip(docs, relevance) if relevant],
+    }
+
+
+async def arewrite_question(state: AgentState, config: RunnableConfig):
+    stop = rewrite_stop_reason(state, config)
+    queries = []
+    if stop is None:
+        num_queries, prompt = rewrite_prompt(state, config)
+        if num_queries > 1:
+            response = await multi_query_rewriter.ainvoke([{"role": "user", "content": prompt}])
+            queries = response.queries[:num_queries]
+        else:
+            queries = [(await query_rewriter.ainvoke([{"role": "user", "content": prompt}])).content]
+    return rewrite_update(state, stop, queries)
+
+
+async def agenerate_answer(state: AgentState, config: RunnableConfig):
+    # sentence embeddings may need a blocking call to the embedding model
+    prompt, compression = await asyncio.to_thread(answer_prompt, state, config)
+    response = await response_model.ainvoke([{"role": "user", "content": prompt}])
+    semantic_cache_for(config).put(state["messages"][0].content, response.content)
+    return {"messages": [response], "compression": compression}
+
+
+async def acheck_cache(state: MessagesState, config: RunnableConfig):
+    return await asyncio.to_thread(check_cache, state, config)
+
+
+async def arerank(state: AgentState, config: RunnableConfig):
+    return await asyncio.to_thread(rerank, state, config)
+
+
+# assemble the graph
 from langgraph.prebuilt import ToolNode
 from langgraph.prebuilt import tools_condition
 
-workflow = StateGraph(MessagesState)
-
-# Define the nodes we will cycle between
-workflow.add_node(generate_query_or_respond)
-workflow.add_node("retrieve", ToolNode([retriever_tool]))
-workflow.add_node(rewrite_question)
-workflow.add_node(generate_answer)
-
-workflow.add_edge(START, "generate_query_or_respond")
-
-# Decide whether to retrieve
-workflow.add_conditional_edges(
-    "generate_query_or_respond",
-    # Assess LLM decision (call `retriever_tool` tool or respond to the user)
-    tools_condition,
-    {
-        # Translate the condition outputs to nodes in our graph
-        "tools": "retrieve",
-        END: END,
-    },
-)
 
-# Edges taken after the `action` node is called.
-workflow.add_conditional_edges(
-    "retrieve",
-    # Assess agent decision
-    grade_documents,
-)
-workflow.add_edge("generate_answer", END)
-workflow.add_edge("rewrite_question", "generate_query_or_respond")
+def build_graph(nodes: dict):
+    """Wire the agentic RAG graph from a mapping of node name to node function."""
+    workflow = StateGraph(AgentState)
 
-# Compile
-graph = workflow.compile()
+    # Define the nodes we will cycle between
+    workflow.add_node("check_cache", nodes["check_cache"])
+    workflow.add_node("generate_query_or_respond", nodes["generate_query_or_respond"])
+    # ToolNode runs several tool calls concurrently, in threads or as tasks
+    workflow.add_node("retrieve", ToolNode([retriever_tool]))
+    if reranker is not None:
+        workflow.add_node("rerank", nodes["rerank"])
+    workflow.add_node("grade_documents", nodes["grade_documents"])
+    workflow.add_node("rewrite_question", nodes["rewrite_question"])
+    workflow.add_node("generate_answer", nodes["generate_answer"])
+
+    workflow.add_edge(START, "check_cache")
+    workflow.add_conditional_edges("check_cache", route_cache)
+
+    # Decide whether to retrieve
+    workflow.add_conditional_edges(
+        "generate_query_or_respond",
+        # Assess LLM decision (call `retriever_tool` tool or respond to the user)
+        tools_condition,
+        {
+            # Translate the condition outputs to nodes in our graph
+            "tools": "retrieve",
+            END: END,
+        },
+    )
+
+    # Edges taken after the `action` node is called.
+    if reranker is not None:
+        workflow.add_edge("retrieve", "rerank")
+        workflow.add_edge("rerank", "grade_documents")
+    else:
+        workflow.add_edge("retrieve", "grade_documents")
+    workflow.add_conditional_edges(
+        "grade_documents",
+        # Assess agent decision
+        route_grading,
+    )
+    workflow.add_edge("generate_answer", END)
+    workflow.add_conditional_edges("rewrite_question", route_rewrite)
+
+    # Compile
+    return workflow.compile()
+
+
+graph = build_graph({
+    "check_cache": check_cache,
+    "generate_query_or_respond": generate_query_or_respond,
+    "rerank": rerank,
+    "grade_documents": grade_documents,
+    "rewrite_question": rewrite_question,
+    "generate_answer": generate_answer,
+})
+# the same graph for `ainvoke` / `astream`
+async_graph = build_graph({
+    "check_cache": acheck_cache,
+    "generate_query_or_respond": agenerate_query_or_respond,
+    "rerank": arerank,
+    "grade_documents": agrade_documents,
+    "rewrite_question": arewrite_question,
+    "generate_answer": agenerate_answer,
+})
 
 # visualize the graph
 try:
@@ -322,23 +1492,202 @@ except Exception:
     # This requires some extra dependencies and is optional
     pass
 
+# token streaming: the answering nodes forward token deltas as they arrive, next to the node updates
+# time-to-first-token is measured from the start of the node, tokens/sec over the rest of its stream
+
+from langchain_core.messages import AIMessageChunk
+
+token_stats = defaultdict(Counter)
+# the nodes whose tokens are the answer; grades and rewritten queries are internal
+ANSWER_NODES = ("generate_query_or_respond", "generate_answer")
+
+
+def stream_with_tokens(graph, inputs, config=None):
+    """Run the graph, printing token deltas as they arrive and node updates as they complete.
+    Records time-to-first-token and tokens/sec per node in `token_stats`.
+    """
+    run_start = time.perf_counter()
+    task_start = {}
+    first_token = {}
+    last_token = {}
+    streaming = {}
+    first_answer_token = None
+
+    for mode, event in graph.stream(inputs, config, stream_mode=["tasks", "messages", "updates"]):
+        now = time.perf_counter()
+        if mode == "tasks":
+            # a task event without a result marks the start of a node
+            if "result" not in event:
+                task_start[event["id"]] = now
+        elif mode == "messages":
+            chunk, metadata = event
+            # whole messages returned by nodes are printed with the updates, and tool call chunks carry no text.
+            # The internal models are tagged nostream, which LangGraph does not stream; the node filter also
+            # covers models called without the tag
+            node = metadata["langgraph_node"]
+            if not isinstance(chunk, AIMessageChunk) or not chunk.content or node not in ANSWER_NODES:
+                continue
+            task = metadata["langgraph_checkpoint_ns"].split(":")[-1]
+            if task not in first_token:
+                first_token[task] = now
+                streaming[task] = node
+                token_stats[node]["ttft_seconds"] += now - task_start.get(task, run_start)
+                token_stats[node]["runs"] += 1
+                if first_answer_token is None:
+                    first_answer_token = now - run_start
+                print(f"Tokens from node {node}: ", end="")
+            last_token[task] = now
+            token_stats[node]["tokens"] += 1
+            print(chunk.content, end="", flush=True)
+        else:
+            for node, update in event.items():
+                streamed = [task for task, streaming_node in streaming.items() if streaming_node == node]
+                for task in streamed:
+                    del streaming[task]
+                    token_stats[node]["stream_seconds"] += last_token[task] - first_token[task]
+                    print("\n")
+                if not update or not update.get("messages"):
+                    continue
+                print("Update from node", node)
+                # the tokens of a streamed node were already printed
+                if not streamed:
+                    update["messages"][-1].pretty_print()
+                if "compression" in update:
+                    print("Context compression:", update["compression"])
+                print("\n\n")
+
+    # the latency users perceive: from the question to the first token of the answer
+    if first_answer_token is not None:
+        token_stats["graph"]["runs"] += 1
+        token_stats["graph"]["ttft_seconds"] += first_answer_token
+
+
+def token_report():
+    """Average time-to-first-token and tokens/sec per node."""
+    report = {}
+    for node, stats in token_stats.items():
+        runs = stats["runs"] or 1
+        report[node] = {"runs": stats["runs"], "ttft_seconds": round(stats["ttft_seconds"] / runs, 3)}
+        if stats["tokens"]:
+            report[node]["tokens"] = stats["tokens"]
+        if stats["stream_seconds"]:
+            # decode rate: the first token of each run is covered by the time-to-first-token
+            report[node]["tokens_per_sec"] = round((stats["tokens"] - stats["runs"]) / stats["stream_seconds"], 1)
+    return report
+
+
+# load benchmark: how many conversations one worker serves at once
+# the sync graph blocks a thread per in-flight conversation, the async graph runs them all on one event loop
+def benchmark_load(questions: list[str], threads: int = 4, config: Optional[RunnableConfig] = None) -> dict:
+    """Answer `questions` with the sync graph on `threads` threads and with the async graph on one
+    event loop thread. Reports wall time, conversations/sec and the peak number of in-flight conversations.
+    The semantic cache is cleared before each pass so that both do the same work.
+    """
+    inputs = [{"messages": [{"role": "user", "content": question}]} for question in questions]
+    report = {}
+
+    in_flight, peak, lock = 0, 0, threading.Lock()
+
+    def enter():
+        nonlocal in_flight, peak
+        with lock:
+            in_flight += 1
+            peak = max(peak, in_flight)
+
+    def leave():
+        nonlocal in_flight
+        with lock:
+            in_flight -= 1
+
+    def run_sync(conversation):
+        enter()
+        try:
+            return graph.invoke(conversation, config)
+        finally:
+            leave()
+
+    async def run_async(conversation):
+        enter()
+        try:
+            return await async_graph.ainvoke(conversation, config)
+        finally:
+            leave()
+
+    async def run_all():
+        return await asyncio.gather(*(run_async(conversation) for conversation in inputs))
+
+    for mode in ["sync", "async"]:
+        for cache in semantic_caches.values():
+            cache.clear()
+        peak = 0
+        start = time.perf_counter()
+        if mode == "sync":
+            with ThreadPoolExecutor(max_workers=threads) as pool:
+                list(pool.map(run_sync, inputs))
+        else:
+            asyncio.run(run_all())
+        seconds = time.perf_counter() - start
+        report[mode] = {
+            "conversations": len(inputs),
+            "threads": threads if mode == "sync" else 1,
+            "seconds": seconds,
+            "conversations_per_sec": len(inputs) / seconds,
+            "peak_in_flight": peak,
+        }
+    return report
+
+# print(benchmark_load([
+#     "What does Lilian Weng say about types of reward hacking?",
+#     "What are the failure modes of diffusion models for video generation?",
+#     "How can in-context reward hacking happen?",
+#     "What is reward tampering?",
+# ] * 4, threads=4))
+
+# async usage
+# async def main():
+#     async for chunk in async_graph.astream(
+#         {"messages": [{"role": "user", "content": "What does Lilian Weng say about types of reward hacking?"}]},
+#         {"configurable": {"num_queries": 3}},
+#     ):
+#         print(chunk)
+# asyncio.run(main())
+
+
 # run the agentic RAG
-# in this example, the model reaches max recursion limit
+# without loop detection the model reaches max recursion limit in this example
 # this is because at the later stages, the output of rewrite_question is always same as the last output, thus fall in an infinite loop
-# to solve this problem, need to check whether a new rewritten question is generated compared to histories, and whether new documents are retrieved
-for chunk in graph.stream(
-    {
+# rewrite_question now checks whether a new rewritten question is generated compared to histories, and whether new documents are retrieved
+# the question is asked twice: the second run is answered by the semantic cache
+# STREAM_TOKENS=0 falls back to whole node updates
+stream_tokens = os.environ.get("STREAM_TOKENS", "1") == "1"
+for question in ["What does Lilian Weng say about types of reward hacking?"] * 2:
+    inputs = {
         "messages": [
             {
                 "role": "user",
-                "content": "What does Lilian Weng say about types of reward hacking?",
+                "content": question,
             }
         ]
     }
-):
-    for node, update in chunk.items():
-        print("Update from node", node)
-        update["messages"][-1].pretty_print()
-        print("\n\n")
+    if stream_tokens:
+        stream_with_tokens(graph, inputs)
+        continue
+    for chunk in graph.stream(inputs):
+        for node, update in chunk.items():
+            if not update.get("messages"):
+                continue
+            print("Update from node", node)
+            update["messages"][-1].pretty_print()
+            if "compression" in update:
+                print("Context compression:", update["compression"])
+            print("\n\n")
+print(f"Semantic cache: {semantic_cache.stats()}")
+print(f"Rewrite loop: {dict(loop_stats)}")
+print(f"Collections: {dict(collection_registry.stats)}, {collection_registry.memory_used() / 2**20:.1f} MiB loaded")
+print(f"Context compression: {dict(compression_stats)}")
+if reranker is not None:
+    print(f"Rerank: {dict(rerank_stats)}, reranker: {dict(reranker.stats)}")
+if stream_tokens:
+    print(f"Streaming: {token_report()}")
 
 
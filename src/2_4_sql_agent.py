@@ -89,20 +89,490 @@ tools = toolkit.get_tools()
 # ):
 #     step["messages"][-1].pretty_print()
 
+# schema cache: the table list, per-table DDL and sample rows are read once per database file
+# instead of reflecting the tables and querying sample rows for every question.
+# The cache is rebuilt when the file's mtime or `PRAGMA schema_version` changes, and kept on disk
+# so that a new process starts warm.
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+
+SAMPLE_ROWS = 3
+
+
+def table_words(name: str) -> set[str]:
+    """Lowercase words of an identifier: `InvoiceLine` -> {"invoiceline", "invoice", "line"}."""
+    parts = re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+", name)
+    return {name.lower()} | {part.lower() for part in parts}
+
+
+def question_words(question: str) -> set[str]:
+    words = set(re.findall(r"[a-z0-9]+", question.lower()))
+    # crude singular forms, so that "tracks" matches Track and "genres" matches Genre
+    return words | {word[:-1] for word in words if word.endswith("s")} | {word[:-2] for word in words if word.endswith("es")}
+
+
+class SchemaCache:
+    """Table names, DDL, columns, foreign keys and sample rows of a SQLite database file.
+
+    `get` returns the cached schema after checking the file's mtime and `PRAGMA schema_version`;
+    a change of either rebuilds it. The schema is also written to `cache_dir`, keyed by the database path.
+    """
+
+    def __init__(self, path: str, cache_dir: str, sample_rows: int = SAMPLE_ROWS):
+        self.path = path
+        self.sample_rows = sample_rows
+        self.cache_path = os.path.join(cache_dir, hashlib.sha256(path.encode("utf-8")).hexdigest()[:16] + ".json")
+        self.stats = Counter()
+        self._schema: Optional[dict] = None
+        self._table_vectors = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+
+    def _version(self) -> tuple[int, int]:
+        """(mtime_ns, schema_version) of the database file."""
+        connection = self._connect()
+        try:
+            schema_version = connection.execute("PRAGMA schema_version").fetchone()[0]
+        finally:
+            connection.close()
+        return os.stat(self.path).st_mtime_ns, schema_version
+
+    def _build(self, mtime_ns: int, schema_version: int) -> dict:
+        connection = self._connect()
+        try:
+            tables = {}
+            rows = connection.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+            ).fetchall()
+            for name, ddl in rows:
+                quoted = '"' + name.replace('"', '""') + '"'
+                columns = [
+                    {"name": column, "type": column_type, "notnull": bool(notnull), "pk": bool(pk)}
+                    for _, column, column_type, notnull, _, pk in connection.execute(f"PRAGMA table_info({quoted})")
+                ]
+                foreign_keys = [
+                    {"column": column, "table": table, "to": to}
+                    for _, _, table, column, to, *_ in connection.execute(f"PRAGMA foreign_key_list({quoted})")
+                ]
+                cursor = connection.execute(f"SELECT * FROM {quoted} LIMIT {self.sample_rows}")
+                samples = [[str(value)[:100] for value in row] for row in cursor.fetchall()]
+                # same layout as SQLDatabase.get_table_info
+                sample_text = "\n".join(
+                    ["\t".join(column["name"] for column in columns)] + ["\t".join(row) for row in samples]
+                )
+                tables[name] = {
+                    "ddl": ddl,
+                    "columns": columns,
+                    "foreign_keys": foreign_keys,
+                    "samples": f"/*\n{len(samples)} rows from {name} table:\n{sample_text}\n*/",
+                    "sample_digest": hashlib.sha256(sample_text.encode("utf-8")).hexdigest()[:16],
+                    # only as of the last schema change, enough to tell large tables from small ones
+                    "rows": connection.execute(f"SELECT count(*) FROM {quoted}").fetchone()[0],
+                }
+        finally:
+            connection.close()
+        return {"path": self.path, "mtime_ns": mtime_ns, "schema_version": schema_version, "tables": tables}
+
+    def get(self) -> dict:
+        with self._lock:
+            mtime_ns, schema_version = self._version()
+            schema = self._schema
+            if schema is None and os.path.exists(self.cache_path):
+                with open(self.cache_path, encoding="utf-8") as f:
+                    schema = json.load(f)
+            if schema is not None and (schema["mtime_ns"], schema["schema_version"]) == (mtime_ns, schema_version):
+                self.stats["hits"] += 1
+                self._schema = schema
+                return schema
+
+            start = time.perf_counter()
+            schema = self._build(mtime_ns, schema_version)
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(schema, f)
+            os.replace(tmp_path, self.cache_path)
+            self.stats["builds"] += 1
+            self.stats["build_seconds"] += time.perf_counter() - start
+            self._schema = schema
+            return schema
+
+    def table_info(self, names: list[str]) -> str:
+        """DDL and sample rows of the tables, like the output of `sql_db_schema`."""
+        tables = self.get()["tables"]
+        return "\n\n".join(f"{tables[name]['ddl']}\n\n{tables[name]['samples']}" for name in names if name in tables)
+
+    def select_tables(self, question: str, max_tables: int = 4) -> list[str]:
+        """Tables whose name or columns share words with the question, best first, plus the tables
+        needed to join two selected tables that have no foreign key between them. All tables when nothing matches.
+        """
+        tables = self.get()["tables"]
+        words = question_words(question)
+        scores = {}
+        for name, table in tables.items():
+            # the whole table name counts more than a part of it, so "tracks" selects Track before PlaylistTrack
+            score = 3 * (name.lower() in words) + 2 * len(table_words(name) - {name.lower()} & words)
+            score += sum(len(table_words(column["name"]) & words) for column in table["columns"] if not column["pk"])
+            if score:
+                scores[name] = score
+        if not scores:
+            return sorted(tables)
+        best = max(scores.values())
+        selected = [name for name in sorted(scores, key=lambda name: (-scores[name], name)) if 2 * scores[name] > best]
+        return self._with_bridges(selected[:max_tables])
+
+    def select_tables_by_embedding(self, question: str, embeddings, max_tables: int = 4) -> list[str]:
+        """Tables whose name and columns are closest to the question in embedding space. The table vectors
+        are computed once per schema version.
+        """
+        schema = self.get()
+        key = (schema["mtime_ns"], schema["schema_version"])
+        if self._table_vectors is None or self._table_vectors[0] != key:
+            names = list(schema["tables"])
+            texts = [
+                f"{name}: " + ", ".join(column["name"] for column in schema["tables"][name]["columns"]) for name in names
+            ]
+            vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            self._table_vectors = (key, names, vectors)
+        _, names, vectors = self._table_vectors
+        query = np.asarray(embeddings.embed_query(question), dtype=np.float32)
+        scores = vectors @ (query / max(np.linalg.norm(query), 1e-12))
+        return self._with_bridges([names[i] for i in np.argsort(-scores)[:max_tables]])
+
+    def _with_bridges(self, selected: list[str]) -> list[str]:
+        tables = self.get()["tables"]
+
+        def linked(a: str, b: str) -> bool:
+            return any(fk["table"] == b for fk in tables[a]["foreign_keys"]) or any(
+                fk["table"] == a for fk in tables[b]["foreign_keys"]
+            )
+
+        for i, a in enumerate(list(selected)):
+            for b in selected[i + 1:]:
+                if linked(a, b):
+                    continue
+                bridge = next((name for name in sorted(tables) if linked(name, a) and linked(name, b)), None)
+                if bridge is not None and bridge not in selected:
+                    selected.append(bridge)
+        return selected
+
+
+schema_cache = SchemaCache(dbfile, os.path.realpath(os.path.join(current_dir, "..", "data", "cache", "schema")))
+# keyword lookup by default; SCHEMA_SELECTION=embedding ranks the tables with the embedding model instead
+if os.environ.get("SCHEMA_SELECTION") == "embedding":
+    from langchain_ollama import OllamaEmbeddings
+
+    schema_embeddings = OllamaEmbeddings(model=os.environ["MODEL"])
+else:
+    schema_embeddings = None
+# time spent in the schema stage of the graph, over all questions
+schema_stats = Counter()
+
+# print(schema_cache.select_tables("Which genre on average has the longest tracks?"))
+# print(schema_cache.table_info(["Genre", "Track"]))
+
 # customizing the agent
 from typing import Literal
-from langchain_core.messages import AIMessage
+from langchain_core.messages import AIMessage, ToolMessage
 from langchain_core.runnables import RunnableConfig
 from langgraph.graph import END, START, MessagesState, StateGraph
 from langgraph.prebuilt import ToolNode
 
 
+class SQLAgentState(MessagesState):
+    # problems the static check in validate_query could not fix, for check_query
+    validation: list[str]
+
+
 get_schema_tool = next(tool for tool in tools if tool.name == "sql_db_schema")
 get_schema_node = ToolNode([get_schema_tool], name="get_schema")
 
-run_query_tool = next(tool for tool in tools if tool.name == "sql_db_query")
+# run_query_tool = next(tool for tool in tools if tool.name == "sql_db_query")
+# run_query_node = ToolNode([run_query_tool], name="run_query")
+
+
+# query pool: `sql_db_query` stringifies the whole result set and has no timeout, so one runaway SELECT
+# from the LLM can pin a worker. Queries run instead on a bounded pool of read-only connections, are
+# interrupted by SQLite's progress handler once their deadline passes, and their rows are streamed into
+# the tool message until a row or byte cap is hit.
+import bisect
+import queue
+from contextlib import contextmanager
+from langchain_core.tools import tool
+
+QUERY_TIMEOUT = float(os.environ.get("SQL_QUERY_TIMEOUT", 5.0))
+QUERY_MAX_ROWS = int(os.environ.get("SQL_QUERY_MAX_ROWS", 100))
+QUERY_MAX_BYTES = int(os.environ.get("SQL_QUERY_MAX_BYTES", 16_384))
+# connections of the pool; further queries wait for one to be checked in
+QUERY_POOL_SIZE = int(os.environ.get("SQL_QUERY_POOL_SIZE", 4))
+# upper bounds of the histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class QueryPool:
+    """Up to `size` read-only connections to a SQLite file, with a wall-clock timeout per query.
+
+    ToolNode runs every tool call on a new thread, so connections are checked out of a shared queue for
+    the duration of a query and checked back in, instead of being kept per thread. They are opened lazily.
+
+    `stats` counts queries, errors, timeouts and truncations; `latency_ms` and `in_use` are histograms of
+    the query latency and of the number of connections busy when a query starts.
+    """
+
+    def __init__(self, path: str, timeout: float = QUERY_TIMEOUT, max_rows: int = QUERY_MAX_ROWS,
+                 max_bytes: int = QUERY_MAX_BYTES, max_string_length: int = 300, progress_steps: int = 1000,
+                 size: int = QUERY_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_string_length = max_string_length
+        self.progress_steps = progress_steps
+        self.stats = Counter()
+        self.latency_ms = Counter()
+        self.in_use = Counter()
+        self._lock = threading.Lock()
+        self._connections: list[sqlite3.Connection] = []
+        self._idle = self._new_idle()
+        self._busy = 0
+
+    def _new_idle(self) -> queue.Queue:
+        # one slot per connection: None until the slot's connection is opened
+        idle = queue.Queue()
+        for _ in range(self.size):
+            idle.put(None)
+        return idle
+
+    @contextmanager
+    def _checkout(self):
+        """A connection of the pool for the duration of the block; waits while all of them are in use."""
+        idle = self._idle
+        connection = idle.get()
+        try:
+            if connection is None:
+                connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+                with self._lock:
+                    self._connections.append(connection)
+            yield connection
+        finally:
+            idle.put(connection)
+
+    def _format(self, row: tuple) -> str:
+        # like SQLDatabase.run: long strings are cut, the rows are printed as a list of tuples
+        return repr(tuple(
+            value[:self.max_string_length] + "..." if isinstance(value, str) and len(value) > self.max_string_length else value
+            for value in row
+        ))
+
+    def run(self, query: str, timeout: Optional[float] = None) -> str:
+        """Result of `query` as the string `sql_db_query` returns, or "Error: ..." like it. The result ends with
+        a truncation marker when the row or byte cap was hit, also when not even the first row fit.
+        """
+        with self._checkout() as connection:
+            return self._run(connection, query, timeout)
+
+    def _run(self, connection: sqlite3.Connection, query: str, timeout: Optional[float]) -> str:
+        with self._lock:
+            self._busy += 1
+            self.in_use[self._busy] += 1
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        # a non-zero return value interrupts the running statement
+        connection.set_progress_handler(lambda: time.monotonic() > deadline, self.progress_steps)
+        start = time.perf_counter()
+        parts, size, truncated = [], 2, None
+        try:
+            cursor = connection.execute(query)
+            while truncated is None:
+                rows = cursor.fetchmany(64)
+                if not rows:
+                    break
+                for row in rows:
+                    if len(parts) == self.max_rows:
+                        truncated = f"row cap of {self.max_rows}"
+                        break
+                    text = self._format(row)
+                    if size + len(text) + 2 > self.max_bytes:
+                        truncated = f"byte cap of {self.max_bytes}"
+                        break
+                    parts.append(text)
+                    size += len(text) + 2
+            cursor.close()
+        except sqlite3.Error as e:
+            if time.monotonic() > deadline:
+                self.stats["timeouts"] += 1
+                return f"Error: query timed out after {self.timeout if timeout is None else timeout}s, simplify it or add filters"
+            self.stats["errors"] += 1
+            return f"Error: ({type(e).__module__}.{type(e).__name__}) {e}\n[SQL: {query}]"
+        finally:
+            connection.set_progress_handler(None, 0)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self._busy -= 1
+                self.stats["queries"] += 1
+                self.latency_ms[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+        if not parts and truncated is None:
+            return ""
+        result = "[" + ", ".join(parts) + "]"
+        if truncated is not None:
+            self.stats["truncated"] += 1
+            result += f"\n... (truncated after {len(parts)} rows by the {truncated}, aggregate or add a LIMIT)"
+        return result
+
+    def explain(self, query: str) -> list[str]:
+        """Details of the `EXPLAIN QUERY PLAN` of `query`; raises sqlite3.Error when it does not compile."""
+        with self._checkout() as connection:
+            deadline = time.monotonic() + self.timeout
+            connection.set_progress_handler(lambda: time.monotonic() > deadline, self.progress_steps)
+            try:
+                return [row[-1] for row in connection.execute(f"EXPLAIN QUERY PLAN {query}")]
+            finally:
+                connection.set_progress_handler(None, 0)
+
+    def report(self) -> dict:
+        def buckets(histogram: Counter) -> dict:
+            labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+            return {labels[i]: histogram[i] for i in sorted(histogram)}
+
+        return {
+            **self.stats,
+            "connections": len(self._connections),
+            "latency_ms": buckets(self.latency_ms),
+            "in_use": dict(sorted(self.in_use.items())),
+        }
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+            # connections checked in after this go back to the old queue, which is dropped
+            self._idle = self._new_idle()
+
+
+query_pool = QueryPool(dbfile)
+
+
+# result cache: the generate_query -> check_query -> run_query loop often runs the same SQL again, within a
+# conversation and across users asking the same thing. Results are cached by normalized SQL and the version
+# of the database file, and evicted least recently used first once over the byte budget.
+from collections import OrderedDict
+
+RESULT_CACHE_BYTES = int(os.environ.get("SQL_RESULT_CACHE_BYTES", 8 * 1024 * 1024))
+# the tokenizer and the canonical form of the SQL text (see sql_text.py)
+from sql_text import SQL_TOKEN, normalize_sql
+
+
+def database_version(path: str) -> tuple:
+    """Changes whenever a write to the database file, or to its write-ahead log, is committed."""
+    version = []
+    for file in (path, f"{path}-wal"):
+        try:
+            stat = os.stat(file)
+            version += [stat.st_mtime_ns, stat.st_size]
+        except FileNotFoundError:
+            version += [0, 0]
+    return tuple(version)
+
+
+def entry_nbytes(key: str, result: str) -> int:
+    return len(key.encode("utf-8")) + len(result.encode("utf-8"))
+
+
+class ResultCache:
+    """Query results keyed by normalized SQL, dropped when the database file changes, LRU under `max_bytes`."""
+
+    def __init__(self, path: str, max_bytes: int = RESULT_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self.nbytes = 0
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._version: Optional[tuple] = None
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        version = database_version(self.path)
+        if version != self._version:
+            if self._entries:
+                self.stats["invalidations"] += 1
+            self._entries.clear()
+            self.nbytes = 0
+            self._version = version
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            self._check_version()
+            result = self._entries.get(key)
+            if result is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return result
+
+    def put(self, key: str, result: str):
+        size = entry_nbytes(key, result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._check_version()
+            if key in self._entries:
+                self.nbytes -= entry_nbytes(key, self._entries.pop(key))
+            self._entries[key] = result
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                old_key, old_result = self._entries.popitem(last=False)
+                self.nbytes -= entry_nbytes(old_key, old_result)
+                self.stats["evictions"] += 1
+
+    def report(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+        }
+
+
+result_cache = ResultCache(dbfile)
+
+
+@tool("sql_db_query")
+def run_query_tool(query: str) -> str:
+    """Execute a SQL query against the database and get back the result..
+    If the query is not correct, an error message will be returned.
+    If an error is returned, rewrite the query, check the query, and try again.
+    """
+    key = normalize_sql(query)
+    result = result_cache.get(key)
+    if result is None:
+        result = query_pool.run(query)
+        # errors and timeouts are not cached, the model is asked to rewrite the query anyway
+        if not result.startswith("Error:"):
+            result_cache.put(key, result)
+    return result
+
+
 run_query_node = ToolNode([run_query_tool], name="run_query")
 
+# print(query_pool.run("SELECT * FROM Track;"))
+# print(query_pool.report())
+# print(normalize_sql("select  Name FROM [Genre]\nWHERE GenreId = 0x1; -- rock"))
+
 
 # Example: create a predetermined tool call
 def list_tables(state: MessagesState):
@@ -121,6 +591,45 @@ def list_tables(state: MessagesState):
     return {"messages": [tool_call_message, tool_message, response]}
 
 
+# the table list and schema served from the schema cache, with the same messages as the tool calls above and
+# below, and the tables chosen by keyword lookup instead of an LLM call
+def list_tables_cached(state: MessagesState):
+    start = time.perf_counter()
+    tool_call = {
+        "name": "sql_db_list_tables",
+        "args": {},
+        "id": "abc123",
+        "type": "tool_call",
+    }
+    tool_call_message = AIMessage(content="", tool_calls=[tool_call])
+    table_names = ", ".join(schema_cache.get()["tables"])
+    tool_message = ToolMessage(content=table_names, name="sql_db_list_tables", tool_call_id=tool_call["id"])
+    response = AIMessage(f"Available tables: {table_names}")
+    schema_stats["seconds"] += time.perf_counter() - start
+
+    return {"messages": [tool_call_message, tool_message, response]}
+
+
+def get_schema_cached(state: MessagesState):
+    start = time.perf_counter()
+    question = next(message.content for message in state["messages"] if message.type == "human")
+    if schema_embeddings is not None:
+        table_names = schema_cache.select_tables_by_embedding(question, schema_embeddings)
+    else:
+        table_names = schema_cache.select_tables(question)
+    tool_call = {
+        "name": "sql_db_schema",
+        "args": {"table_names": ", ".join(table_names)},
+        "id": f"schema_{hashlib.sha256(question.encode('utf-8')).hexdigest()[:8]}",
+        "type": "tool_call",
+    }
+    tool_message = ToolMessage(content=schema_cache.table_info(table_names), name="sql_db_schema", tool_call_id=tool_call["id"])
+    schema_stats["seconds"] += time.perf_counter() - start
+    schema_stats["questions"] += 1
+
+    return {"messages": [AIMessage(content="", tool_calls=[tool_call]), tool_message]}
+
+
 # Example: force a model to create a tool call
 def call_get_schema(state: MessagesState):
     # Note that LangChain enforces that all models accept `tool_choice="any"`
@@ -149,19 +658,138 @@ DO NOT make any DML statements (INSERT, UPDATE, DELETE, DROP etc.) to the databa
 )
 
 
+# few-shot examples: verified (question, SQL) pairs, appended whenever a query returned rows and the
+# conversation ended with an answer. The most similar ones are added to the prompt of generate_query,
+# so that fewer run_query -> generate_query retries are needed. SQL_FEW_SHOT=0 turns them off.
+from langchain_ollama import OllamaEmbeddings
+
+FEW_SHOT = os.environ.get("SQL_FEW_SHOT", "1") != "0"
+FEW_SHOT_K = int(os.environ.get("SQL_FEW_SHOT_K", 3))
+FEW_SHOT_MIN_SIMILARITY = float(os.environ.get("SQL_FEW_SHOT_MIN_SIMILARITY", 0.5))
+
+
+def question_key(question: str) -> str:
+    return " ".join(question.lower().split())
+
+
+class ExampleStore:
+    """Verified (question, SQL) pairs in a JSONL file, searched by the cosine similarity of the questions."""
+
+    def __init__(self, path: str, embeddings):
+        self.path = path
+        self.embeddings = embeddings
+        self.examples: list[dict] = []
+        self.vectors = None
+        self.stats = Counter()
+        self._query_vectors: dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                examples = [json.loads(line) for line in f if line.strip()]
+            # the last SQL of a question wins
+            self.examples = list({question_key(example["question"]): example for example in examples}.values())
+            if self.examples:
+                self.vectors = self._normalize(embeddings.embed_documents([example["question"] for example in self.examples]))
+
+    @staticmethod
+    def _normalize(vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    def _query_vector(self, question: str) -> np.ndarray:
+        # generate_query runs several times per question, the question is embedded once
+        vector = self._query_vectors.get(question)
+        if vector is None:
+            if len(self._query_vectors) >= 1024:
+                self._query_vectors.clear()
+            vector = self._query_vectors[question] = self._normalize(self.embeddings.embed_query(question))
+        return vector
+
+    def search(self, question: str, k: int = FEW_SHOT_K, min_similarity: float = FEW_SHOT_MIN_SIMILARITY) -> list[dict]:
+        if self.vectors is None:
+            return []
+        scores = self.vectors @ self._query_vector(question)
+        top = [i for i in np.argsort(-scores)[:k] if scores[i] >= min_similarity]
+        self.stats["searches"] += 1
+        self.stats["examples_used"] += len(top)
+        return [self.examples[i] for i in top]
+
+    def add(self, question: str, sql: str) -> bool:
+        """Store the pair, unless the question is already stored with the same SQL."""
+        key = question_key(question)
+        with self._lock:
+            index = next((i for i, example in enumerate(self.examples) if question_key(example["question"]) == key), None)
+            if index is not None and self.examples[index]["sql"] == sql:
+                return False
+            example = {"question": question, "sql": sql}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(example) + "\n")
+            if index is not None:
+                self.examples[index] = example
+            else:
+                vector = self._query_vector(question)[None, :]
+                self.vectors = vector if self.vectors is None else np.vstack([self.vectors, vector])
+                self.examples.append(example)
+            self.stats["added"] += 1
+            return True
+
+
+example_store = ExampleStore(
+    os.path.realpath(os.path.join(current_dir, "..", "data", "cache", "sql_examples.jsonl")),
+    schema_embeddings or OllamaEmbeddings(model=os.environ["MODEL"]),
+) if FEW_SHOT else None
+# per question: the generate_query -> run_query rounds and the LLM calls
+iteration_stats = Counter()
+
+
+def few_shot_prompt(question: str) -> str:
+    if example_store is None:
+        return ""
+    examples = example_store.search(question)
+    if not examples:
+        return ""
+    return "\nHere are verified queries for similar questions about this database:\n\n" + "\n\n".join(
+        f"Question: {example['question']}\nSQL: {example['sql']}" for example in examples
+    ) + "\n"
+
+
 def generate_query(state: MessagesState):
+    question = next(message.content for message in state["messages"] if message.type == "human")
     system_message = {
         "role": "system",
-        "content": generate_query_system_prompt,
+        # "content": generate_query_system_prompt,
+        "content": generate_query_system_prompt + few_shot_prompt(question),
     }
     # We do not force a tool call here, to allow the model to
     # respond naturally when it obtains the solution.
     llm_with_tools = llm.bind_tools([run_query_tool])
     response = llm_with_tools.invoke([system_message] + state["messages"])
+    iteration_stats["iterations"] += 1
+    iteration_stats["llm_calls"] += 1
 
     return {"messages": [response]}
 
 
+def record_example(state: MessagesState):
+    """Store the question and the last query that returned rows, once the model answered."""
+    iteration_stats["questions"] += 1
+    if example_store is None:
+        return {}
+    messages = state["messages"]
+    question = next(message.content for message in messages if message.type == "human")
+    result = next((message for message in reversed(messages) if message.type == "tool" and message.name == "sql_db_query"), None)
+    if result is None or not result.content or result.content.startswith("Error:"):
+        return {}
+    sql = next(
+        call["args"]["query"]
+        for message in reversed(messages) if message.type == "ai"
+        for call in message.tool_calls if call["id"] == result.tool_call_id
+    )
+    example_store.add(question, sql)
+    return {}
+
+
 check_query_system_prompt = """
 You are a SQL expert with a strong attention to detail.
 Double check the {dialect} query for common mistakes, including:
@@ -181,7 +809,7 @@ You will call the appropriate tool to execute the query after running this check
 """.format(dialect=db.dialect)
 
 
-def check_query(state: MessagesState):
+def check_query(state: SQLAgentState):
     system_message = {
         "role": "system",
         "content": check_query_system_prompt,
@@ -190,40 +818,204 @@ def check_query(state: MessagesState):
     # Generate an artificial user message to check
     tool_call = state["messages"][-1].tool_calls[0]
     user_message = {"role": "user", "content": tool_call["args"]["query"]}
+    if state.get("validation"):
+        # the problems found by validate_query, as SQL comments after the query
+        user_message["content"] += "\n" + "\n".join(f"-- problem: {problem}" for problem in state["validation"])
     llm_with_tools = llm.bind_tools([run_query_tool], tool_choice="any")
     response = llm_with_tools.invoke([system_message, user_message])
     response.id = state["messages"][-1].id
+    iteration_stats["llm_calls"] += 1
 
     return {"messages": [response]}
 
 
-def should_continue(state: MessagesState) -> Literal[END, "check_query"]:
+def should_continue(state: MessagesState) -> Literal["record_example", "validate_query"]:
     messages = state["messages"]
     last_message = messages[-1]
     if not last_message.tool_calls:
-        return END
+        # return END
+        return "record_example"
     else:
-        return "check_query"
+        # return "check_query"
+        return "validate_query"
+
+
+# static check: most of the mistakes check_query asks the LLM about can be found mechanically. The query is
+# compiled with EXPLAIN QUERY PLAN on the read-only pool, which reports syntax errors and unknown tables and
+# columns, and checked against the cached schema. Problems with a safe rewrite are fixed here; only the others
+# go through the LLM check.
+LARGE_TABLE_ROWS = int(os.environ.get("SQL_LARGE_TABLE_ROWS", 100_000))
+# what a statement after WITH and its common table expressions can be
+CTE_STATEMENTS = ("select", "values", "insert", "replace", "update", "delete")
+validation_stats = Counter()
+
+
+def sql_tokens(query: str) -> list[tuple[str, str, int, int]]:
+    """(kind, lowercased text, start, end) of the tokens of `query`, without comments."""
+    return [
+        (match.lastgroup, match.group().lower(), match.start(), match.end())
+        for match in SQL_TOKEN.finditer(query)
+        if match.lastgroup != "comment"
+    ]
 
 
-builder = StateGraph(MessagesState)
-builder.add_node(list_tables)
-builder.add_node(call_get_schema)
-builder.add_node(get_schema_node, "get_schema")
+def statement_keyword(tokens: list) -> str:
+    """The keyword that decides what the statement does: its first one, or for WITH the first one after the
+    common table expressions. Words elsewhere, like the replace() function or a column named update, do not count.
+    """
+    if tokens[0][1] != "with":
+        return tokens[0][1]
+    depth = 0
+    for kind, text, _, _ in tokens[1:]:
+        depth += (text == "(") - (text == ")")
+        if depth == 0 and kind == "word" and text in CTE_STATEMENTS:
+            return text
+    return "with"
+
+
+def table_aliases(tokens: list, tables: dict) -> dict[str, str]:
+    """Alias or name -> table, for the tables after FROM and JOIN."""
+    names = {name.lower(): name for name in tables}
+    aliases = {}
+    for i, (_, text, _, _) in enumerate(tokens[:-1]):
+        if text not in ("from", "join"):
+            continue
+        table = names.get(tokens[i + 1][1].strip('"[]`'))
+        if table is None:
+            continue
+        aliases[table.lower()] = table
+        rest = tokens[i + 2:i + 4]
+        if rest and rest[0][1] == "as":
+            rest = rest[1:]
+        if rest and rest[0][0] in ("word", "identifier") and rest[0][1] not in ("where", "join", "on", "group", "order", "limit", "inner", "left", "cross", "natural", "union"):
+            aliases[rest[0][1].strip('"[]`')] = table
+    return aliases
+
+
+def validate_sql(query: str, top_k: int = 5) -> tuple[str, list[str], list[str]]:
+    """Statically check `query`. Returns the query with the safe fixes applied, the fixes, and the problems
+    that need a rewrite.
+    """
+    tables = schema_cache.get()["tables"]
+    tokens = sql_tokens(query)
+    while tokens and tokens[-1][1] == ";":
+        tokens.pop()
+    if not tokens:
+        return query, [], ["the query is empty"]
+    if statement_keyword(tokens) != "select":
+        return query, [], ["only SELECT statements are allowed, DO NOT make any DML statements"]
+    if any(text == ";" for _, text, _, _ in tokens):
+        return query, [], ["only one statement can be run at a time"]
+
+    try:
+        plan = query_pool.explain(query)
+    except sqlite3.Error as e:
+        problem = str(e)
+        aliases = table_aliases(tokens, tables)
+        if "no such column" in problem and aliases:
+            problem += "; the columns are " + "; ".join(
+                f"{table}: " + ", ".join(column["name"] for column in tables[table]["columns"])
+                for table in sorted(set(aliases.values()))
+            )
+        return query, [], [problem]
+
+    aliases = table_aliases(tokens, tables)
+    fixes, problems, inserts = [], [], []
+    # NOT IN (SELECT column FROM table ...) returns no rows at all once the subquery returns a NULL
+    for i in range(len(tokens) - 6):
+        if [text for _, text, _, _ in tokens[i:i + 4]] != ["not", "in", "(", "select"]:
+            continue
+        # the selected column, optionally qualified, then FROM table [alias]
+        j = i + 4
+        column = tokens[j][1].strip('"[]`')
+        if j + 2 < len(tokens) and tokens[j + 1][1] == ".":
+            j += 2
+            column = tokens[j][1].strip('"[]`')
+        if j + 2 >= len(tokens) or tokens[j + 1][1] != "from":
+            continue
+        table = table_aliases(tokens[j + 1:j + 3], tables).get(tokens[j + 2][1].strip('"[]`'))
+        if table is None:
+            continue
+        column = next((c["name"] for c in tables[table]["columns"] if c["name"].lower() == column and not c["notnull"] and not c["pk"]), None)
+        if column is None:
+            continue
+        # as written in the query, with its qualifier
+        selected = query[tokens[i + 4][2]:tokens[j][3]]
+        k = j + 3
+        if k < len(tokens) and tokens[k][0] in ("word", "identifier") and tokens[k][1] not in ("where", "group", "order", "limit"):
+            k += 1
+        if k < len(tokens) and tokens[k][1] == ")":
+            inserts.append((tokens[k][2], f" WHERE {selected} IS NOT NULL"))
+            fixes.append(f"excluded NULLs of the nullable column {table}.{column} from the NOT IN subquery")
+        else:
+            problems.append(f"NOT IN on the nullable column {table}.{column}, add `{column} IS NOT NULL` to the subquery or use NOT EXISTS")
+
+    for detail in plan:
+        match = re.fullmatch(r"SCAN (\S+)", detail)
+        table = aliases.get(match.group(1).lower()) if match else None
+        if table is not None and tables[table].get("rows", 0) > LARGE_TABLE_ROWS:
+            problems.append(f"full scan of {table} ({tables[table]['rows']} rows), filter on an indexed column")
+
+    depth, has_limit = 0, False
+    for _, text, _, _ in tokens:
+        depth += (text == "(") - (text == ")")
+        has_limit |= depth == 0 and text == "limit"
+    if not has_limit:
+        # after the last token, so not inside a trailing comment
+        inserts.append((tokens[-1][3], f" LIMIT {top_k}"))
+        fixes.append(f"added LIMIT {top_k}")
+    fixed = query
+    for position, text in sorted(inserts, reverse=True):
+        fixed = fixed[:position] + text + fixed[position:]
+    return fixed, fixes, problems
+
+
+def validate_query(state: SQLAgentState):
+    start = time.perf_counter()
+    message = state["messages"][-1]
+    tool_call = message.tool_calls[0]
+    query, fixes, problems = validate_sql(tool_call["args"]["query"])
+    validation_stats["seconds"] += time.perf_counter() - start
+    validation_stats["queries"] += 1
+    validation_stats["fixed"] += bool(fixes)
+    if problems:
+        validation_stats["llm_checks"] += 1
+        return {"validation": problems}
+    # the same message with the fixed query, replacing the one generate_query returned
+    response = AIMessage(content=message.content, tool_calls=[{**tool_call, "args": {**tool_call["args"], "query": query}}], id=message.id)
+    return {"messages": [response], "validation": []}
+
+
+def route_validation(state: SQLAgentState) -> Literal["check_query", "run_query"]:
+    return "check_query" if state.get("validation") else "run_query"
+
+
+# builder = StateGraph(MessagesState)
+builder = StateGraph(SQLAgentState)
+# builder.add_node(list_tables)
+# builder.add_node(call_get_schema)
+# builder.add_node(get_schema_node, "get_schema")
+builder.add_node("list_tables", list_tables_cached)
+builder.add_node("get_schema", get_schema_cached)
 builder.add_node(generate_query)
+builder.add_node(validate_query)
 builder.add_node(check_query)
 builder.add_node(run_query_node, "run_query")
+builder.add_node(record_example)
 
 builder.add_edge(START, "list_tables")
-builder.add_edge("list_tables", "call_get_schema")
-builder.add_edge("call_get_schema", "get_schema")
+# builder.add_edge("list_tables", "call_get_schema")
+# builder.add_edge("call_get_schema", "get_schema")
+builder.add_edge("list_tables", "get_schema")
 builder.add_edge("get_schema", "generate_query")
 builder.add_conditional_edges(
     "generate_query",
     should_continue,
 )
+builder.add_conditional_edges("validate_query", route_validation)
 builder.add_edge("check_query", "run_query")
 builder.add_edge("run_query", "generate_query")
+builder.add_edge("record_example", END)
 
 agent = builder.compile()
 
@@ -242,10 +1034,23 @@ except Exception:
 
 question = "Which genre on average has the longest tracks?"
 
+start = time.perf_counter()
 for step in agent.stream(
     {"messages": [{"role": "user", "content": question}]},
     stream_mode="values",
 ):
     step["messages"][-1].pretty_print()
+print(f"Answered in {time.perf_counter() - start:.3f}s")
+
+print(f"Schema stage: {dict(schema_stats)}, schema cache: {dict(schema_cache.stats)}")
+print(f"Query pool: {query_pool.report()}")
+print(f"Result cache: {result_cache.report()}")
+print(f"Query validation: {dict(validation_stats)}")
+if iteration_stats["questions"]:
+    print(
+        f"Per answered question: {iteration_stats['iterations'] / iteration_stats['questions']:.2f} iterations, "
+        f"{iteration_stats['llm_calls'] / iteration_stats['questions']:.2f} LLM calls"
+        + (f", few-shot examples: {dict(example_store.stats)}" if example_store is not None else "")
+    )
 
 
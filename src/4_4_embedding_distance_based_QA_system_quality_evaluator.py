@@ -1 +1,337 @@
 # reference: https://langchain-opentutorial.gitbook.io/langchain-opentutorial/16-evaluations/06-langsmith-embedding-distance-evaluation#defining-functions-for-rag-performance-testing
+# reference: ranking metrics https://en.wikipedia.org/wiki/Discounted_cumulative_gain
+
+# offline retrieval evaluation: run a labelled query set through retriever tools built like `retrieve_blog_posts`
+# in 2_2_agentic_rag.py, over the same index configurations (rag_index.py), and report recall@k, MRR and nDCG@k
+# next to p50/p95/p99 latency and queries/sec, so that an index, chunking or rerank change can be checked for
+# trading quality against speed.
+# Results are written as JSON and compared with the previous run of the same name.
+# Everything runs offline: documents are embedded with a deterministic hashing embedder.
+
+# setup environment
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import re
+import time
+from typing import Callable, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+results_dir = os.path.realpath(os.path.join(current_dir, "..", "data", "cache", "eval"))
+
+
+# deterministic fake embedder: a hashed bag of words, so that queries sharing words with a document are close to it
+class HashingEmbeddings(Embeddings):
+    """Embed text as the L2-normalized signed count of its hashed lowercase words."""
+
+    def __init__(self, size: int = 256):
+        self.size = size
+
+    def _embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.sha1(word.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.size
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+# labelled dataset
+# corpus: one JSON object per line with "id", "text" and optional "metadata"
+# queries: one JSON object per line with "query" and "relevant_ids"
+def load_jsonl(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_dataset(corpus_path: str, queries_path: str) -> tuple[list[Document], list[dict]]:
+    docs = [Document(page_content=row["text"], metadata=row.get("metadata", {}), id=row["id"]) for row in load_jsonl(corpus_path)]
+    return docs, load_jsonl(queries_path)
+
+
+def synthetic_dataset(n_topics: int = 20, docs_per_topic: int = 25, n_queries: int = 200, seed: int = 0) -> tuple[list[Document], list[dict]]:
+    """A reproducible corpus of documents mixing topic words, document-specific words and filler words.
+    Each query asks for words of one document; that document is the relevant one.
+    """
+    rng = random.Random(seed)
+    filler = [f"word{i}" for i in range(300)]
+    docs = []
+    for topic in range(n_topics):
+        topic_words = [f"topic{topic}term{i}" for i in range(15)]
+        for n in range(docs_per_topic):
+            own_words = [f"doc{topic}x{n}key{i}" for i in range(3)]
+            words = rng.choices(topic_words, k=8) + own_words + rng.choices(filler, k=20)
+            rng.shuffle(words)
+            docs.append(Document(page_content=" ".join(words), metadata={"topic": topic}, id=f"doc-{topic}-{n}"))
+    queries = []
+    for _ in range(n_queries):
+        doc = rng.choice(docs)
+        words = doc.page_content.split()
+        own = [word for word in words if "key" in word]
+        query = " ".join(rng.sample(own, 2) + rng.sample([word for word in words if "term" in word], 2))
+        queries.append({"query": query, "relevant_ids": [doc.id]})
+    return docs, queries
+
+
+# retriever under test: the same tool shape as `retrieve_blog_posts`, whose artifact holds the retrieved documents
+from langchain.tools.retriever import create_retriever_tool
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import InMemoryVectorStore
+
+
+def retriever_tool_of(retriever: BaseRetriever):
+    return create_retriever_tool(
+        retriever,
+        "retrieve_blog_posts",
+        "Search and return information about Lilian Weng blog posts.",
+        response_format="content_and_artifact",
+    )
+
+
+def build_retriever_tool(docs: list[Document], embeddings: Embeddings, search_type: str = "similarity", **search_kwargs):
+    vectorstore = InMemoryVectorStore(embeddings)
+    vectorstore.add_documents(docs)
+    return retriever_tool_of(vectorstore.as_retriever(search_type=search_type, search_kwargs=search_kwargs))
+
+
+# the index of the agentic RAG (see rag_index.py): exact, IVF and quantized dense search, BM25 + dense
+# fusion, and reranking. Every store is built from the same embedded corpus, with its BM25 index
+from rag_index import (
+    BM25Index,
+    HybridRetriever,
+    IVFVectorStore,
+    NumpyVectorStore,
+    OllamaReranker,
+    QuantizedVectorStore,
+    RerankRetriever,
+)
+
+
+def build_store(store_cls, docs: list[Document], vectors: list[list[float]], embeddings: Embeddings, **kwargs):
+    store = store_cls(embedding=embeddings, keyword_index=BM25Index(), **kwargs)
+    store.add_embeddings(
+        [doc.page_content for doc in docs], vectors, metadatas=[doc.metadata for doc in docs], ids=[doc.id for doc in docs]
+    )
+    return store
+
+
+def index_configs(docs: list[Document], embeddings: Embeddings, k: int = 10, nprobes=(1, 4, 16), pq_m: int = 16,
+                  reranker: Optional[OllamaReranker] = None) -> dict:
+    """Retriever tools for the index configurations of the agentic RAG, keyed by configuration name."""
+    vectors = embeddings.embed_documents([doc.page_content for doc in docs])
+    exact = build_store(NumpyVectorStore, docs, vectors, embeddings)
+    ivf = build_store(IVFVectorStore, docs, vectors, embeddings)
+    ivf.train()
+    int8 = build_store(QuantizedVectorStore, docs, vectors, embeddings, quantization="int8")
+    int8.train_quantizer()
+    pq = build_store(QuantizedVectorStore, docs, vectors, embeddings, quantization="pq", pq_m=pq_m)
+    pq.train_quantizer()
+
+    configs = {
+        "dense_exact": exact.as_retriever(search_kwargs={"k": k}),
+        **{f"ivf_nprobe{nprobe}": ivf.as_retriever(search_kwargs={"k": k, "nprobe": nprobe}) for nprobe in nprobes},
+        "int8": int8.as_retriever(search_kwargs={"k": k, "rerank_k": 0}),
+        "int8_exact_rerank": int8.as_retriever(search_kwargs={"k": k, "rerank_k": 4 * k}),
+        f"pq{pq_m}": pq.as_retriever(search_kwargs={"k": k, "rerank_k": 0}),
+        f"pq{pq_m}_exact_rerank": pq.as_retriever(search_kwargs={"k": k, "rerank_k": 4 * k}),
+        "hybrid_rrf": HybridRetriever(vectorstore=exact, k=k, fetch_k=2 * k),
+    }
+    if reranker is not None:
+        configs["hybrid_rrf_rerank"] = RerankRetriever(
+            retriever=HybridRetriever(vectorstore=exact, k=2 * k, fetch_k=2 * k), reranker=reranker, k=k
+        )
+    return {name: retriever_tool_of(retriever) for name, retriever in configs.items()}
+
+
+def snapshot_configs(directory: str, embeddings: Embeddings, k: int = 10, reranker: Optional[OllamaReranker] = None) -> dict:
+    """Retriever tools over the index snapshot written by 2_2_agentic_rag.py, as it is loaded there."""
+    store = QuantizedVectorStore.load_snapshot(directory, embeddings, {})
+    configs = {
+        "snapshot_dense": store.as_retriever(search_kwargs={"k": k}),
+        "snapshot_hybrid_rrf": HybridRetriever(vectorstore=store, k=k, fetch_k=2 * k),
+    }
+    if reranker is not None:
+        configs["snapshot_hybrid_rrf_rerank"] = RerankRetriever(
+            retriever=HybridRetriever(vectorstore=store, k=2 * k, fetch_k=2 * k), reranker=reranker, k=k
+        )
+    return {name: retriever_tool_of(retriever) for name, retriever in configs.items()}
+
+
+def tool_retrieve(tool) -> Callable[[str], list[Document]]:
+    """Call a `content_and_artifact` retriever tool the way ToolNode does, and return its documents."""
+    counter = itertools.count()
+
+    def retrieve(query: str) -> list[Document]:
+        message = tool.invoke({"type": "tool_call", "name": tool.name, "args": {"query": query}, "id": f"eval-{next(counter)}"})
+        return message.artifact or []
+
+    return retrieve
+
+
+# metrics, with binary relevance
+def recall_at_k(ranked_ids: list[str], relevant: set[str], k: int) -> float:
+    return len(set(ranked_ids[:k]) & relevant) / len(relevant) if relevant else 0.0
+
+
+def reciprocal_rank(ranked_ids: list[str], relevant: set[str]) -> float:
+    for rank, doc_id in enumerate(ranked_ids, start=1):
+        if doc_id in relevant:
+            return 1 / rank
+    return 0.0
+
+
+def ndcg_at_k(ranked_ids: list[str], relevant: set[str], k: int) -> float:
+    dcg = sum(1 / math.log2(rank + 1) for rank, doc_id in enumerate(ranked_ids[:k], start=1) if doc_id in relevant)
+    ideal = sum(1 / math.log2(rank + 1) for rank in range(1, min(len(relevant), k) + 1))
+    return dcg / ideal if ideal else 0.0
+
+
+def evaluate_retriever(retrieve: Callable[[str], list[Document]], queries: list[dict], k: int = 10, name: str = "retriever", warmup: int = 5) -> dict:
+    """Run every query through `retrieve` and return the averaged metrics, latency percentiles and per-query results.
+
+    Queries per second is measured over the sequential run, i.e. it is the inverse of the mean latency.
+    """
+    for query in queries[:warmup]:
+        retrieve(query["query"])
+
+    per_query, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        docs = retrieve(query["query"])
+        latencies.append(time.perf_counter() - start)
+        ranked_ids = [doc.id for doc in docs]
+        relevant = set(query["relevant_ids"])
+        per_query.append({
+            "query": query["query"],
+            "retrieved_ids": ranked_ids[:k],
+            f"recall@{k}": recall_at_k(ranked_ids, relevant, k),
+            "mrr": reciprocal_rank(ranked_ids[:k], relevant),
+            f"ndcg@{k}": ndcg_at_k(ranked_ids, relevant, k),
+            "latency_ms": latencies[-1] * 1000,
+        })
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "name": name,
+        "k": k,
+        "queries": len(queries),
+        f"recall@{k}": float(np.mean([row[f"recall@{k}"] for row in per_query])),
+        "mrr": float(np.mean([row["mrr"] for row in per_query])),
+        f"ndcg@{k}": float(np.mean([row[f"ndcg@{k}"] for row in per_query])),
+        "latency_ms": {
+            "p50": float(np.percentile(latencies_ms, 50)),
+            "p95": float(np.percentile(latencies_ms, 95)),
+            "p99": float(np.percentile(latencies_ms, 99)),
+        },
+        "qps": len(queries) / sum(latencies),
+        "per_query": per_query,
+    }
+
+
+# machine-readable results: one JSON file per named run, compared with the file of the previous run
+QUALITY_METRICS = ("recall@{k}", "mrr", "ndcg@{k}")
+
+
+def write_results(result: dict, directory: str = results_dir) -> str:
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{result['name']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({**result, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+    return path
+
+
+def compare_results(previous: dict, current: dict, quality_tolerance: float = 0.005, latency_tolerance: float = 0.2) -> list[str]:
+    """Regressions of `current` against `previous`: quality metrics that dropped by more than
+    `quality_tolerance`, and p95 latency or queries/sec that got worse by more than `latency_tolerance` (relative).
+    """
+    regressions = []
+    for metric in QUALITY_METRICS:
+        metric = metric.format(k=current["k"])
+        if metric in previous and current[metric] < previous[metric] - quality_tolerance:
+            regressions.append(f"{metric}: {previous[metric]:.4f} -> {current[metric]:.4f}")
+    if current["latency_ms"]["p95"] > previous["latency_ms"]["p95"] * (1 + latency_tolerance):
+        regressions.append(f"p95 latency: {previous['latency_ms']['p95']:.2f}ms -> {current['latency_ms']['p95']:.2f}ms")
+    if current["qps"] < previous["qps"] * (1 - latency_tolerance):
+        regressions.append(f"qps: {previous['qps']:.1f} -> {current['qps']:.1f}")
+    return regressions
+
+
+def print_summary(result: dict):
+    k = result["k"]
+    latency = result["latency_ms"]
+    print(
+        f"{result['name']}: recall@{k}={result[f'recall@{k}']:.3f} mrr={result['mrr']:.3f} ndcg@{k}={result[f'ndcg@{k}']:.3f} "
+        f"latency p50={latency['p50']:.2f}ms p95={latency['p95']:.2f}ms p99={latency['p99']:.2f}ms qps={result['qps']:.1f}"
+    )
+
+
+# run the evaluation
+# set EVAL_CORPUS and EVAL_QUERIES to evaluate a labelled dataset instead of the synthetic one
+# the retriever of the agentic RAG can be evaluated the same way from a session where it is built:
+# evaluate_retriever(tool_retrieve(retriever_tool), queries, k=4, name="agentic_rag")
+def run_evaluation(configs: dict, queries: list[dict], k: int = 10, directory: str = results_dir) -> dict:
+    """Evaluate each named retriever tool, write its results and report regressions against the previous run."""
+    results = {}
+    for name, tool in configs.items():
+        previous_path = os.path.join(directory, f"{name}.json")
+        previous: Optional[dict] = None
+        if os.path.exists(previous_path):
+            with open(previous_path, encoding="utf-8") as f:
+                previous = json.load(f)
+        result = evaluate_retriever(tool_retrieve(tool), queries, k=k, name=name)
+        print_summary(result)
+        if previous is not None and previous.get("k") == k:
+            for regression in compare_results(previous, result):
+                print(f"  regression against the previous run: {regression}")
+        print(f"  results written to {write_results(result, directory)}")
+        results[name] = result
+    return results
+
+
+# set EVAL_RERANK_MODEL to also evaluate hybrid retrieval followed by the reranker
+# set EVAL_INDEX_DIR (e.g. data/cache/index) and EVAL_QUERIES (e.g. the synthetic_qa.jsonl of 4_6, whose
+# relevant ids are chunk ids of that snapshot) to evaluate the snapshot of the agentic RAG with its embedding model
+if os.environ.get("EVAL_CORPUS") and os.environ.get("EVAL_QUERIES"):
+    docs, queries = load_dataset(os.environ["EVAL_CORPUS"], os.environ["EVAL_QUERIES"])
+else:
+    docs, queries = synthetic_dataset()
+
+embeddings = HashingEmbeddings()
+k = int(os.environ.get("EVAL_K", 10))
+reranker = OllamaReranker(
+    os.environ["EVAL_RERANK_MODEL"], base_url=os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+) if os.environ.get("EVAL_RERANK_MODEL") else None
+run_evaluation(
+    {
+        "similarity": build_retriever_tool(docs, embeddings, k=k),
+        "mmr": build_retriever_tool(docs, embeddings, search_type="mmr", k=k, fetch_k=4 * k),
+        **index_configs(docs, embeddings, k=k, reranker=reranker),
+    },
+    queries,
+    k=k,
+)
+
+if os.environ.get("EVAL_INDEX_DIR") and os.environ.get("EVAL_QUERIES"):
+    from langchain_ollama import OllamaEmbeddings
+
+    # duplicates rejected by 4_6 have no query
+    snapshot_queries = [query for query in load_jsonl(os.environ["EVAL_QUERIES"]) if query.get("query")]
+    run_evaluation(
+        snapshot_configs(os.environ["EVAL_INDEX_DIR"], OllamaEmbeddings(model=os.environ["MODEL"]), k=k, reranker=reranker),
+        snapshot_queries,
+        k=k,
+    )
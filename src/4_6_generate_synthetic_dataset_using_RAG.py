@@ -1 +1,285 @@
 # reference: https://langchain-opentutorial.gitbook.io/langchain-opentutorial/19-cookbook/08-syntheticdataset/13-syntheticdatasetgenerationusingrag#domain-specific-rag-evaluation-dataset
+
+# synthetic question / answer / context triples for load-testing and evaluating the agentic RAG graph
+# contexts are sampled from the chunks of 2_2_agentic_rag.py, questions and answers are generated by the LLM
+# through a bounded pool of async workers. Every finished sample is appended to a JSONL checkpoint, so an
+# interrupted run resumes where it stopped, and questions too similar to an earlier one are dropped.
+
+# setup environment
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.documents import Document
+
+load_dotenv()
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+index_dir = os.path.realpath(os.path.join(current_dir, "..", "data", "cache", "index"))
+output_path = os.path.realpath(os.path.join(current_dir, "..", "data", "cache", "synthetic_qa.jsonl"))
+
+# the pages of 2_2_agentic_rag.py, with its loader, chunking and chunk ids
+from rag_corpus import CHUNK_OVERLAP, CHUNK_SIZE, URLS as urls, web_loader, with_chunk_ids
+
+
+# chunks: read from the index snapshot written by 2_2_agentic_rag.py, so that the generated questions
+# refer to the chunk ids the retriever returns; without a snapshot, split the pages like 2_2_agentic_rag.py does
+def load_snapshot_chunks(directory: str) -> list[Document]:
+    with open(os.path.join(directory, "CURRENT"), encoding="utf-8") as f:
+        path = os.path.join(directory, f.read().strip())
+    offsets = np.load(os.path.join(path, "offsets.npy"))
+    with open(os.path.join(path, "texts.bin"), "rb") as f:
+        data = f.read()
+    with open(os.path.join(path, "metadata.json"), encoding="utf-8") as f:
+        metadata = json.load(f)
+    return [
+        Document(page_content=data[start:end].decode("utf-8"), metadata=meta, id=doc_id)
+        for doc_id, meta, start, end in zip(metadata["ids"], metadata["metadatas"], offsets[:-1], offsets[1:])
+    ]
+
+
+def split_pages(urls: list[str]) -> list[Document]:
+    # the splitter of 2_2_agentic_rag.py, which records the character span of every chunk
+    from rag_index import CachedTokenTextSplitter
+
+    loader = web_loader(urls)
+    docs = loader.load()
+    for url, error in loader.failed.items():
+        print(f"Failed to load {url}: {error}")
+    text_splitter = CachedTokenTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    doc_splits = []
+    for chunk_id, doc in with_chunk_ids(text_splitter.split_documents(docs)):
+        doc.id = chunk_id
+        doc_splits.append(doc)
+    return doc_splits
+
+
+try:
+    doc_splits = load_snapshot_chunks(index_dir)
+    print(f"Loaded {len(doc_splits)} chunks from the index snapshot")
+except FileNotFoundError:
+    doc_splits = split_pages(urls)
+    print(f"Split {len(doc_splits)} chunks from {len(urls)} pages")
+
+
+# sampling: chunks are only 50 tokens long, so a context is a window of consecutive chunks of one page
+CONTEXT_CHUNKS = int(os.environ.get("SYNTHETIC_CONTEXT_CHUNKS", 3))
+
+
+def in_page_order(page: list[Document]) -> list[Document]:
+    """The chunks of one page in text order: by their character offset when every chunk has a valid span,
+    otherwise in the order they were given, which for a snapshot is the order they were split in.
+    """
+    def has_span(chunk: Document) -> bool:
+        start, end = chunk.metadata.get("start_index", -1), chunk.metadata.get("end_index", -1)
+        return isinstance(start, int) and isinstance(end, int) and 0 <= start and end - start == len(chunk.page_content)
+
+    if all(has_span(chunk) for chunk in page):
+        return sorted(page, key=lambda chunk: chunk.metadata["start_index"])
+    return page
+
+
+def sample_contexts(chunks: list[Document], n: int, window: int = CONTEXT_CHUNKS, seed: int = 0) -> list[dict]:
+    """`n` reproducible samples of `window` consecutive chunks. A sample's id is derived from its chunk ids,
+    so the same samples are drawn again when a run is resumed.
+    """
+    by_source: dict[str, list[Document]] = {}
+    for chunk in chunks:
+        by_source.setdefault(chunk.metadata.get("source", ""), []).append(chunk)
+    pages = [in_page_order(page) for page in by_source.values() if len(page) >= window]
+    weights = [len(page) - window + 1 for page in pages]
+    rng = random.Random(seed)
+    samples, seen = [], set()
+    # at most every window once
+    n = min(n, sum(weights))
+    while len(samples) < n:
+        page = rng.choices(pages, weights)[0]
+        start = rng.randrange(len(page) - window + 1)
+        ids = [chunk.id for chunk in page[start:start + window]]
+        sample_id = hashlib.sha256("\0".join(ids).encode("utf-8")).hexdigest()[:16]
+        if sample_id in seen:
+            continue
+        seen.add(sample_id)
+        samples.append({
+            "id": sample_id,
+            "chunk_ids": ids,
+            "source": page[start].metadata.get("source"),
+            "context": " ".join(chunk.page_content for chunk in page[start:start + window]),
+        })
+    return samples
+
+
+# generation
+from langchain_ollama import ChatOllama, OllamaEmbeddings
+from pydantic import BaseModel, Field
+
+QA_PROMPT = (
+    "You are creating an evaluation dataset for a question-answering system over blog posts.\n"
+    "Read the context and write one question that can be answered from the context alone, "
+    "and its answer in at most three sentences. Do not refer to 'the context' in the question.\n"
+    "Context: {context}"
+)
+
+
+class SyntheticQA(BaseModel):
+    """A question answerable from the context, and its answer."""
+
+    question: str = Field(description="A self-contained question answered by the context")
+    answer: str = Field(description="The answer, using only the context")
+
+
+generator_model = ChatOllama(
+    model=os.environ["MODEL"],
+    temperature=0.7,
+)
+embeddings = OllamaEmbeddings(
+    model=os.environ["MODEL"],
+)
+
+MAX_CONCURRENCY = int(os.environ.get("SYNTHETIC_MAX_CONCURRENCY", 8))
+MAX_RETRIES = int(os.environ.get("SYNTHETIC_MAX_RETRIES", 3))
+# questions at least this similar (cosine) to an accepted question are dropped as near-duplicates
+DUPLICATE_THRESHOLD = float(os.environ.get("SYNTHETIC_DUPLICATE_THRESHOLD", 0.92))
+
+
+def read_checkpoint(path: str) -> list[dict]:
+    """Records of a previous run. A last line cut short by a crash is removed from the file,
+    so that new records start on a line of their own.
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        data = f.read()
+    complete = data.rfind(b"\n") + 1
+    if complete < len(data):
+        os.truncate(path, complete)
+    records = []
+    for line in data[:complete].splitlines():
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records
+
+
+async def backoff(attempt: int):
+    """Exponential backoff with jitter before retry `attempt + 1`."""
+    await asyncio.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.5))
+
+
+def normalize(vectors: list[list[float]]) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+async def generate_dataset(samples: list[dict], path: str, max_concurrency: int = MAX_CONCURRENCY, max_retries: int = MAX_RETRIES) -> dict:
+    """Generate a question and answer for every sample not yet in the checkpoint at `path`.
+
+    Each record is appended as one JSON line: status "ok" with the triple, or status "duplicate" when the
+    question was too similar to an accepted one. Failed samples are not recorded, so they are retried on the
+    next run. Returns the generation stats.
+    """
+    records = read_checkpoint(path)
+    done = {record["id"] for record in records}
+    accepted = [record for record in records if record["status"] == "ok"]
+    # the accepted questions are embedded again, to dedupe against them
+    vectors = normalize(await embeddings.aembed_documents([record["question"] for record in accepted])) if accepted else None
+
+    stats = Counter(resumed=len(done))
+    queue: asyncio.Queue = asyncio.Queue()
+    for sample in samples:
+        if sample["id"] not in done:
+            queue.put_nowait(sample)
+    structured_model = generator_model.with_structured_output(SyntheticQA)
+    start = time.perf_counter()
+
+    with open(path, "a", encoding="utf-8") as checkpoint:
+
+        def append(record: dict):
+            checkpoint.write(json.dumps(record) + "\n")
+            checkpoint.flush()
+
+        async def worker():
+            nonlocal vectors
+            while True:
+                try:
+                    sample = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                qa: Optional[SyntheticQA] = None
+                for attempt in range(max_retries):
+                    try:
+                        qa = await structured_model.ainvoke([{"role": "user", "content": QA_PROMPT.format(context=sample["context"])}])
+                        if qa.question.strip() and qa.answer.strip():
+                            break
+                        stats["empty_responses"] += 1
+                        qa = None
+                    except Exception as e:
+                        stats[f"error_{type(e).__name__}"] += 1
+                        if attempt + 1 < max_retries:
+                            await backoff(attempt)
+                if qa is None:
+                    stats["failed"] += 1
+                    continue
+
+                vector = None
+                for attempt in range(max_retries):
+                    try:
+                        vector = normalize(await embeddings.aembed_documents([qa.question]))
+                        break
+                    except Exception as e:
+                        stats[f"error_{type(e).__name__}"] += 1
+                        if attempt + 1 < max_retries:
+                            await backoff(attempt)
+                if vector is None:
+                    stats["failed"] += 1
+                    continue
+                record = {
+                    "id": sample["id"],
+                    "question": qa.question,
+                    "answer": qa.answer,
+                    "contexts": [sample["context"]],
+                    "source": sample["source"],
+                    # the chunks a retriever should return, see EVAL_QUERIES in 4_4
+                    "relevant_ids": sample["chunk_ids"],
+                }
+                # no await between the check and the update, so workers cannot accept two near-duplicates
+                similarity = float((vectors @ vector[0]).max()) if vectors is not None else 0.0
+                if similarity >= DUPLICATE_THRESHOLD:
+                    stats["duplicates"] += 1
+                    append({"id": sample["id"], "status": "duplicate", "question": qa.question, "similarity": similarity})
+                    continue
+                vectors = vector if vectors is None else np.vstack([vectors, vector])
+                stats["generated"] += 1
+                # "query" makes the file usable as EVAL_QUERIES of 4_4 as is
+                append({**record, "status": "ok", "query": qa.question})
+                if stats["generated"] % 50 == 0:
+                    elapsed = time.perf_counter() - start
+                    print(f"{stats['generated']} generated, {stats['generated'] / elapsed:.2f}/s, {stats['failed']} failed")
+
+        await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+
+    elapsed = time.perf_counter() - start
+    return {
+        **stats,
+        "accepted_total": len(accepted) + stats["generated"],
+        "seconds": elapsed,
+        "generated_per_sec": stats["generated"] / elapsed if elapsed else 0.0,
+    }
+
+
+# run the generator; rerun after an interruption to resume from the checkpoint
+SYNTHETIC_QA_COUNT = int(os.environ.get("SYNTHETIC_QA_COUNT", 1000))
+samples = sample_contexts(doc_splits, SYNTHETIC_QA_COUNT)
+os.makedirs(os.path.dirname(output_path), exist_ok=True)
+report = asyncio.run(generate_dataset(samples, output_path))
+print(f"Synthetic QA: {report}")
+print(f"Dataset written to {output_path}")
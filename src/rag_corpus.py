@@ -0,0 +1,43 @@
+# the corpus of 2_2_agentic_rag.py: its pages, how they are loaded and chunked, and the ids of the chunks.
+# Shared with 4_6_generate_synthetic_dataset_using_RAG.py, so that the chunks it splits without an index
+# snapshot have the ids the retriever returns
+import hashlib
+import os
+from collections import defaultdict
+from typing import Iterable, Iterator
+
+from langchain_core.documents import Document
+
+from web_loader import CachedWebLoader
+
+URLS = [
+    "https://lilianweng.github.io/posts/2024-11-28-reward-hacking/",
+    "https://lilianweng.github.io/posts/2024-07-07-hallucination/",
+    "https://lilianweng.github.io/posts/2024-04-12-diffusion-video/",
+]
+
+CHUNK_SIZE = 50
+CHUNK_OVERLAP = 25
+
+WEB_CACHE_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "cache", "web"))
+
+
+def web_loader(urls: list[str] = URLS) -> CachedWebLoader:
+    return CachedWebLoader(urls, cache_dir=WEB_CACHE_DIR)
+
+
+def fingerprint(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def with_chunk_ids(chunks: Iterable[Document]) -> Iterator[tuple[str, Document]]:
+    """Pair every chunk with its content-addressed id: the fingerprint of its source and text, suffixed with
+    `-1`, `-2`, ... when the same text occurs again in the same source. `chunks` must be in split order.
+    """
+    occurrences = defaultdict(int)
+    for chunk in chunks:
+        chunk_id = fingerprint(chunk.metadata.get("source", ""), chunk.page_content)
+        occurrences[chunk_id] += 1
+        if occurrences[chunk_id] > 1:
+            chunk_id = f"{chunk_id}-{occurrences[chunk_id] - 1}"
+        yield chunk_id, chunk
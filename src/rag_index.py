@@ -0,0 +1,1070 @@
+# the index behind the agentic RAG of 2_2_agentic_rag.py: the token-based splitter, dense vector stores
+# (exact, IVF, int8 / PQ quantized), the BM25 keyword index, the hybrid retriever that fuses both, the reranker
+# and the merging of retrieved chunks into passages.
+# Kept out of the script so that 4_4_embedding_distance_based_QA_system_quality_evaluator.py can evaluate
+# the same index configurations, and so that they can be tested
+import copy
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from array import array
+from collections import Counter, OrderedDict, defaultdict
+from collections.abc import Callable, Iterable, Sequence
+from typing import Any, Optional
+
+import numpy as np
+import requests
+import tiktoken
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pydantic import ConfigDict
+
+
+# chunking: the recursive splitter with memoized tiktoken token counts
+class CachedTokenTextSplitter(RecursiveCharacterTextSplitter):
+    """Same chunks as `RecursiveCharacterTextSplitter.from_tiktoken_encoder`, with memoized token counts.
+
+    Chunks carry their character span in the source document as `start_index` and `end_index` metadata,
+    so that `text[start_index:end_index] == page_content`. The spans are not taken from `add_start_index`:
+    it searches from `chunk_overlap` characters before the end of the previous chunk, but the overlap is
+    counted in tokens here, so most chunks would get a wrong start or -1.
+    """
+
+    def __init__(self, encoding_name: str = "gpt2", cache_size: int = 65536, **kwargs):
+        encoding = tiktoken.get_encoding(encoding_name)
+
+        @functools.lru_cache(maxsize=cache_size)
+        def token_count(text: str) -> int:
+            return len(encoding.encode(text, allowed_special=set(), disallowed_special="all"))
+
+        super().__init__(length_function=token_count, **kwargs)
+        self.token_count = token_count
+
+    def create_documents(self, texts, metadatas=None):
+        metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for text, metadata in zip(texts, metadatas):
+            # chunks come in text order, and each one starts after the start of the previous one
+            start = -1
+            for chunk in self.split_text(text):
+                found = text.find(chunk, start + 1)
+                if found >= 0:
+                    start = found
+                documents.append(Document(
+                    page_content=chunk,
+                    metadata={
+                        **copy.deepcopy(metadata),
+                        "start_index": found,
+                        "end_index": found + len(chunk) if found >= 0 else -1,
+                    },
+                ))
+        return documents
+
+    def iter_split_documents(self, docs, processes: Optional[int] = None, min_parallel: int = 32):
+        """Yield the chunks of `docs` in order.
+
+        Large batches are split in a process pool. Workers are forked so that they inherit this splitter;
+        where fork is not available the documents are split in this process.
+        """
+        docs = list(docs)
+        if len(docs) < min_parallel or "fork" not in multiprocessing.get_all_start_methods():
+            for doc in docs:
+                yield from self.split_documents([doc])
+            return
+        global _pool_splitter
+        _pool_splitter = self
+        with multiprocessing.get_context("fork").Pool(processes) as pool:
+            for chunks in pool.imap(_split_in_worker, docs, chunksize=4):
+                yield from chunks
+
+
+def _split_in_worker(doc):
+    return _pool_splitter.split_documents([doc])
+
+
+# merge retrieved chunks of the same source into passages, so that the overlap between neighbours is sent once
+def merge_chunks(docs: list[Document], source_texts: Optional[dict[str, str]] = None) -> list[str]:
+    """Merge chunks of the same source whose character spans overlap or touch, and drop duplicates.
+    Passages are ordered by the best rank of their chunks.
+
+    A span is only trusted when `start_index >= 0`, it is as long as the chunk, it matches the source text
+    when that is in `source_texts`, and it agrees character for character with the passage it overlaps.
+    Other chunks are kept whole. Duplicates are detected ignoring case, punctuation and whitespace.
+    """
+    source_texts = source_texts or {}
+    spans = defaultdict(list)
+    passages = {}
+
+    def keep(rank, text):
+        passages.setdefault(" ".join(tokenize(text)), (rank, text))
+
+    for rank, doc in enumerate(docs):
+        source, text = doc.metadata.get("source"), doc.page_content
+        start, end = doc.metadata.get("start_index", -1), doc.metadata.get("end_index", -1)
+        if (
+            source is not None
+            and isinstance(start, int) and isinstance(end, int)
+            and 0 <= start and end - start == len(text)
+            and (source not in source_texts or source_texts[source][start:end] == text)
+        ):
+            spans[source].append((start, end, rank, text))
+        else:
+            keep(rank, text)
+
+    for source, source_spans in spans.items():
+        source_text = source_texts.get(source)
+        source_spans.sort()
+        start, end, rank, text = source_spans[0]
+        for next_start, next_end, next_rank, next_text in source_spans[1:]:
+            overlap = min(end, next_end) - next_start
+            # the splitter strips the whitespace between neighbouring chunks
+            touches = next_start == end + 1 and (source_text is None or source_text[end].isspace())
+            if touches or (overlap >= 0 and text[next_start - start:][:overlap] == next_text[:overlap]):
+                if next_end > end:
+                    gap = (source_text[end] if source_text is not None else " ") if touches else ""
+                    text += gap + next_text[max(end - next_start, 0):]
+                    end = next_end
+                rank = min(rank, next_rank)
+                continue
+            keep(rank, text)
+            start, end, rank, text = next_start, next_end, next_rank, next_text
+        keep(rank, text)
+    return [text for _, text in sorted(passages.values())]
+
+
+# keep the embeddings in one contiguous float32 matrix instead of InMemoryVectorStore's per-document lists
+
+
+SNAPSHOT_FORMAT_VERSION = 1
+
+
+# keyword search: BM25 over an inverted index with array-backed postings
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+class BM25Index:
+    """Inverted index scored with Okapi BM25.
+
+    Postings loaded from a snapshot live in CSR arrays (`offsets`, `docs`, `tfs`); postings of documents
+    added afterwards are appended to per-term `array`s, so the index can grow without rebuilding.
+    Deleted documents are masked out at query time.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._vocab: dict[str, int] = {}
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._docs = np.zeros(0, dtype=np.int32)
+        self._tfs = np.zeros(0, dtype=np.int32)
+        self._new_docs: dict[int, array] = {}
+        self._new_tfs: dict[int, array] = {}
+        self._ids: list[str] = []
+        self._doc_of: dict[str, int] = {}
+        self._doc_len = array("i")
+        self._alive = bytearray()
+        self._total_len = 0
+
+    def __len__(self) -> int:
+        return len(self._doc_of)
+
+    def add(self, ids: Sequence[str], texts: Sequence[str]):
+        self.delete([doc_id for doc_id in ids if doc_id in self._doc_of])
+        for doc_id, text in zip(ids, texts):
+            doc = len(self._ids)
+            tokens = tokenize(text)
+            for term, tf in Counter(tokens).items():
+                term_id = self._vocab.setdefault(term, len(self._vocab))
+                self._new_docs.setdefault(term_id, array("i")).append(doc)
+                self._new_tfs.setdefault(term_id, array("i")).append(tf)
+            self._ids.append(doc_id)
+            self._doc_of[doc_id] = doc
+            self._doc_len.append(len(tokens))
+            self._alive.append(1)
+            self._total_len += len(tokens)
+
+    def delete(self, ids: Sequence[str]):
+        for doc_id in ids:
+            doc = self._doc_of.pop(doc_id, None)
+            if doc is not None:
+                self._alive[doc] = 0
+                self._total_len -= self._doc_len[doc]
+
+    def _postings(self, term_id: int) -> tuple[np.ndarray, np.ndarray]:
+        docs, tfs = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
+        if term_id + 1 < len(self._offsets):
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            docs, tfs = self._docs[start:end], self._tfs[start:end]
+        if term_id in self._new_docs:
+            docs = np.concatenate([docs, np.array(self._new_docs[term_id], dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.array(self._new_tfs[term_id], dtype=np.int32)])
+        return docs, tfs
+
+    def term_stats(self, query: str) -> dict:
+        """Collection statistics for the terms of `query`: document count, total length and document
+        frequencies. Summed over several indexes, they make `search` scores comparable across them.
+        """
+        alive = np.frombuffer(self._alive, dtype=np.uint8).astype(bool)
+        df = Counter()
+        for term in set(tokenize(query)):
+            if term in self._vocab:
+                df[term] = int(alive[self._postings(self._vocab[term])[0]].sum())
+        return {"n_docs": len(self._doc_of), "total_len": self._total_len, "df": df}
+
+    def search(self, query: str, k: int = 4, stats: Optional[dict] = None) -> list[tuple[str, float]]:
+        """Return up to `k` (id, score) pairs of documents that share at least one term with `query`.
+
+        With `stats` (see `term_stats`), idf and average length are taken from them instead of this index.
+        """
+        if not self._doc_of:
+            return []
+        n_docs = len(self._doc_of) if stats is None else stats["n_docs"]
+        avg_len = (self._total_len if stats is None else stats["total_len"]) / n_docs or 1.0
+        doc_len = np.frombuffer(self._doc_len, dtype=np.int32) if self._doc_len else np.zeros(0, dtype=np.int32)
+        alive = np.frombuffer(self._alive, dtype=np.uint8).astype(bool)
+        scores = np.zeros(len(self._ids), dtype=np.float32)
+        for term in set(tokenize(query)):
+            if term not in self._vocab:
+                continue
+            docs, tfs = self._postings(self._vocab[term])
+            docs, tfs = docs[alive[docs]], tfs[alive[docs]]
+            if len(docs) == 0:
+                continue
+            df = len(docs) if stats is None else stats["df"][term]
+            idf = np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * doc_len[docs] / avg_len)
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + norm)
+        matches = np.flatnonzero(scores > 0)
+        top = matches[np.argsort(-scores[matches], kind="stable")[:k]]
+        return [(self._ids[doc], float(scores[doc])) for doc in top]
+
+    def save(self, path: str):
+        """Write the live documents as `bm25.npz` (CSR postings) and `bm25_vocab.json` under `path`."""
+        live = [doc for doc in range(len(self._ids)) if self._alive[doc]]
+        renumber = np.full(len(self._ids), -1, dtype=np.int32)
+        renumber[live] = np.arange(len(live), dtype=np.int32)
+        vocab, docs, tfs, offsets = [], [], [], [0]
+        for term, term_id in self._vocab.items():
+            term_docs, term_tfs = self._postings(term_id)
+            keep = renumber[term_docs] >= 0
+            if keep.any():
+                vocab.append(term)
+                docs.append(renumber[term_docs[keep]])
+                tfs.append(term_tfs[keep])
+                offsets.append(offsets[-1] + int(keep.sum()))
+        np.savez(
+            os.path.join(path, "bm25.npz"),
+            offsets=np.array(offsets, dtype=np.int64),
+            docs=np.concatenate(docs) if docs else np.zeros(0, dtype=np.int32),
+            tfs=np.concatenate(tfs) if tfs else np.zeros(0, dtype=np.int32),
+            doc_len=np.array([self._doc_len[doc] for doc in live], dtype=np.int32),
+            params=np.array([self.k1, self.b]),
+        )
+        with open(os.path.join(path, "bm25_vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(vocab, f)
+
+    @classmethod
+    def load(cls, path: str, ids: list[str]) -> "BM25Index":
+        """Load an index saved with `save`. `ids` are the ids of the saved documents, in order."""
+        with np.load(os.path.join(path, "bm25.npz")) as data:
+            index = cls(*data["params"].tolist())
+            index._offsets, index._docs, index._tfs = data["offsets"], data["docs"], data["tfs"]
+            index._doc_len = array("i", data["doc_len"].tobytes())
+        with open(os.path.join(path, "bm25_vocab.json"), encoding="utf-8") as f:
+            index._vocab = {term: term_id for term_id, term in enumerate(json.load(f))}
+        index._ids = list(ids)
+        index._doc_of = {doc_id: doc for doc, doc_id in enumerate(ids)}
+        index._alive = bytearray(b"\x01" * len(ids))
+        index._total_len = int(sum(index._doc_len))
+        return index
+
+
+class SnapshotTexts(Sequence):
+    """Chunk texts of a snapshot, decoded on access from the memory-mapped `texts.bin`."""
+
+    def __init__(self, path: str, offsets: np.ndarray):
+        self._data = np.memmap(path, dtype=np.uint8, mode="r") if offsets[-1] else np.zeros(0, dtype=np.uint8)
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(len(self)))]
+        return self._data[self._offsets[row]:self._offsets[row + 1]].tobytes().decode("utf-8")
+
+
+class NumpyVectorStore(VectorStore):
+    """Vector store backed by one float32 matrix with L2-normalized rows.
+
+    A search is a single matrix-vector product followed by an `argpartition` top-k.
+    The matrix grows geometrically, and deleted rows are masked out rather than
+    removed so that row numbers stay stable.
+    """
+
+    def __init__(self, embedding: Embeddings, initial_capacity: int = 1024, keyword_index: Optional[BM25Index] = None):
+        self.embedding = embedding
+        self.initial_capacity = initial_capacity
+        # when set, the keyword index is kept in sync with every add and delete, and saved in snapshots
+        self.keyword_index = keyword_index
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._alive = np.zeros(0, dtype=bool)
+        self._size = 0
+        self._n_deleted = 0
+        self._ids: list[str] = []
+        self._texts: list[str] = []
+        self._metadatas: list[dict] = []
+        self._row_of: dict[str, int] = {}
+        self.manifest: dict = {}
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def __len__(self) -> int:
+        return self._size - self._n_deleted
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._row_of
+
+    def _reserve(self, n: int, dim: int):
+        if self._matrix.shape[1] not in (0, dim):
+            raise ValueError(f"Expected embeddings of dimension {self._matrix.shape[1]}, got {dim}")
+        capacity = self._matrix.shape[0]
+        if self._size + n <= capacity and self._matrix.shape[1] == dim:
+            return
+        capacity = max(self._size + n, 2 * capacity, self.initial_capacity)
+        matrix = np.zeros((capacity, dim), dtype=np.float32)
+        alive = np.zeros(capacity, dtype=bool)
+        if self._size:
+            matrix[:self._size] = self._matrix[:self._size]
+            alive[:self._size] = self._alive[:self._size]
+        self._matrix, self._alive = matrix, alive
+
+    def add_embeddings(
+        self,
+        texts: Sequence[str],
+        vectors: Sequence[Sequence[float]],
+        metadatas: Optional[Sequence[dict]] = None,
+        ids: Optional[Sequence[Optional[str]]] = None,
+    ) -> list[str]:
+        """Add already embedded texts. Existing ids are overwritten."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(texts) == 0:
+            return []
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+        ids = [doc_id or str(uuid.uuid4()) for doc_id in (ids or [None] * len(texts))]
+        self.delete([doc_id for doc_id in ids if doc_id in self._row_of])
+        self._reserve(len(texts), vectors.shape[1])
+        rows = slice(self._size, self._size + len(texts))
+        self._matrix[rows] = vectors
+        self._alive[rows] = True
+        if not isinstance(self._texts, list):
+            # the first write to a loaded snapshot decodes its texts into memory
+            self._texts = list(self._texts)
+        for row, (doc_id, text, metadata) in enumerate(
+            zip(ids, texts, metadatas or [{}] * len(texts)), start=self._size
+        ):
+            self._ids.append(doc_id)
+            self._texts.append(text)
+            self._metadatas.append(metadata)
+            self._row_of[doc_id] = row
+        self._size += len(texts)
+        if self.keyword_index is not None:
+            self.keyword_index.add(ids, texts)
+        return ids
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[list[dict]] = None,
+        *,
+        ids: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        return self.add_embeddings(texts, self.embedding.embed_documents(texts), metadatas, ids)
+
+    def delete(self, ids: Optional[Sequence[str]] = None, **kwargs: Any) -> None:
+        for doc_id in ids or []:
+            row = self._row_of.pop(doc_id, None)
+            if row is not None:
+                self._alive[row] = False
+                self._n_deleted += 1
+        if self.keyword_index is not None:
+            self.keyword_index.delete(ids or [])
+
+    def _document(self, row: int) -> Document:
+        return Document(id=self._ids[row], page_content=self._texts[row], metadata=self._metadatas[row])
+
+    def get_by_ids(self, ids: Sequence[str], /) -> list[Document]:
+        return [self._document(self._row_of[doc_id]) for doc_id in ids if doc_id in self._row_of]
+
+    def vectors_by_ids(self, ids: Sequence[str]) -> dict[str, np.ndarray]:
+        """Stored unit-length vectors of the ids that are in the store."""
+        return {doc_id: np.asarray(self._matrix[self._row_of[doc_id]]) for doc_id in ids if doc_id in self._row_of}
+
+    def update_metadata(self, ids: Sequence[str], metadatas: Sequence[dict]):
+        """Replace the metadata of stored documents, e.g. the span of a chunk whose text did not change."""
+        for doc_id, metadata in zip(ids, metadatas):
+            self._metadatas[self._row_of[doc_id]] = metadata
+
+    def metadata_by_id(self) -> dict[str, dict]:
+        """Metadata of every live document, keyed by id."""
+        return {doc_id: self._metadatas[row] for doc_id, row in self._row_of.items()}
+
+    def _normalize_query(self, embedding: Sequence[float]) -> np.ndarray:
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        return query / norm if norm else query
+
+    def _top_k(self, scores: np.ndarray, k: int) -> np.ndarray:
+        """Return the positions of the `k` highest scores, best first."""
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top], kind="stable")]
+
+    def _search_rows(self, query: np.ndarray, k: int, **kwargs: Any) -> tuple[np.ndarray, np.ndarray]:
+        """Exact search over all live rows. Returns (rows, cosine similarities)."""
+        scores = self._matrix[:self._size] @ query
+        if self._n_deleted:
+            scores[~self._alive[:self._size]] = -np.inf
+        rows = self._top_k(scores, min(k, len(self)))
+        return rows, scores[rows]
+
+    def similarity_search_with_score_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        filter: Optional[Callable[[Document], bool]] = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        if len(self) == 0:
+            return []
+        query = self._normalize_query(embedding)
+        if filter is None:
+            rows, scores = self._search_rows(query, k, **kwargs)
+            return [(self._document(row), float(score)) for row, score in zip(rows, scores)]
+        # with a filter we cannot know the candidate count up front, so widen the search until enough pass
+        fetch_k = k
+        while True:
+            rows, scores = self._search_rows(query, fetch_k, **kwargs)
+            results = [
+                (doc, float(score))
+                for doc, score in ((self._document(row), score) for row, score in zip(rows, scores))
+                if filter(doc)
+            ]
+            if len(results) >= k or fetch_k >= len(self):
+                return results[:k]
+            fetch_k *= 4
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, **kwargs)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # scores are already cosine similarities
+        return lambda score: score
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: Optional[list[dict]] = None,
+        *,
+        ids: Optional[list[str]] = None,
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        store = cls(embedding=embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+    def _save_arrays(self, path: str, rows: np.ndarray):
+        """Hook for subclasses to store extra arrays in a snapshot. `rows` are the saved rows in order."""
+
+    def _load_arrays(self, path: str):
+        """Hook for subclasses to restore the arrays written by `_save_arrays`."""
+
+    def save_snapshot(self, directory: str, manifest: dict, keep: int = 2) -> str:
+        """Write the live rows as a new snapshot version under `directory` and make it the current one.
+
+        A version holds `embeddings.f32` (raw float32 rows), `texts.bin` with `offsets.npy` (utf-8 texts
+        and their byte offsets), `metadata.json` (ids and metadata) and `manifest.json`, which records
+        `manifest` together with the format version, row count and dimension. Only the newest `keep`
+        versions are kept. Returns the version name.
+        """
+        version = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        path = os.path.join(directory, version)
+        os.makedirs(path)
+
+        rows = np.flatnonzero(self._alive[:self._size])
+        self._matrix[rows].tofile(os.path.join(path, "embeddings.f32"))
+        encoded = [self._texts[row].encode("utf-8") for row in rows]
+        with open(os.path.join(path, "texts.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+        np.save(os.path.join(path, "offsets.npy"), np.cumsum([0] + [len(text) for text in encoded], dtype=np.int64))
+        with open(os.path.join(path, "metadata.json"), "w", encoding="utf-8") as f:
+            json.dump({"ids": [self._ids[row] for row in rows], "metadatas": [self._metadatas[row] for row in rows]}, f)
+        self._save_arrays(path, rows)
+        if self.keyword_index is not None:
+            self.keyword_index.save(path)
+
+        self.manifest = {
+            **manifest,
+            "format_version": SNAPSHOT_FORMAT_VERSION,
+            "version": version,
+            "count": len(rows),
+            "dim": int(self._matrix.shape[1]),
+        }
+        with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=2)
+
+        # readers follow CURRENT, which is swapped atomically once the version is complete
+        pointer = os.path.join(directory, f"CURRENT.{version}")
+        with open(pointer, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(pointer, os.path.join(directory, "CURRENT"))
+        self._prune_snapshots(directory, keep)
+        return version
+
+    @staticmethod
+    def _prune_snapshots(directory: str, keep: int) -> None:
+        """Delete all but the `keep` most recently created versions, never the one CURRENT points to.
+
+        Versions are ordered by modification time, not by name: the timestamp in a name has a resolution
+        of one second, so the names of versions saved within the same second sort by their random suffix.
+        """
+        with open(os.path.join(directory, "CURRENT"), encoding="utf-8") as f:
+            current = f.read().strip()
+        versions = []
+        for entry in os.scandir(directory):
+            if entry.is_dir():
+                try:
+                    versions.append((entry.stat().st_mtime_ns, entry.name))
+                except FileNotFoundError:
+                    continue
+        for _, old in sorted(versions)[:-keep]:
+            if old != current:
+                shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+
+    @classmethod
+    def load_snapshot(cls, directory: str, embedding: Embeddings, expected: dict, **kwargs: Any) -> "NumpyVectorStore":
+        """Memory-map the current snapshot under `directory` read-only.
+
+        Processes that load the same snapshot share one page-cache copy of the vectors. Raises
+        FileNotFoundError when there is no snapshot, and ValueError when the manifest does not match
+        `expected`, e.g. because the embedding model or the chunking configuration changed.
+        """
+        with open(os.path.join(directory, "CURRENT"), encoding="utf-8") as f:
+            path = os.path.join(directory, f.read().strip())
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(
+                f"Snapshot {manifest.get('version')} has format version {manifest.get('format_version')}, "
+                f"expected {SNAPSHOT_FORMAT_VERSION}"
+            )
+        mismatched = {
+            key: {"snapshot": manifest.get(key), "expected": value}
+            for key, value in expected.items()
+            if manifest.get(key) != value
+        }
+        if mismatched:
+            raise ValueError(f"Snapshot {manifest['version']} does not match the current configuration: {mismatched}")
+
+        store = cls(embedding=embedding, **kwargs)
+        count, dim = manifest["count"], manifest["dim"]
+        if count:
+            store._matrix = np.memmap(os.path.join(path, "embeddings.f32"), dtype=np.float32, mode="r", shape=(count, dim))
+        else:
+            store._matrix = np.zeros((0, dim), dtype=np.float32)
+        store._alive = np.ones(count, dtype=bool)
+        store._size = count
+        store._texts = SnapshotTexts(os.path.join(path, "texts.bin"), np.load(os.path.join(path, "offsets.npy")))
+        with open(os.path.join(path, "metadata.json"), encoding="utf-8") as f:
+            metadata = json.load(f)
+        store._ids = metadata["ids"]
+        store._metadatas = metadata["metadatas"]
+        store._row_of = {doc_id: row for row, doc_id in enumerate(store._ids)}
+        store.manifest = manifest
+        store._load_arrays(path)
+        if os.path.exists(os.path.join(path, "bm25.npz")):
+            store.keyword_index = BM25Index.load(path, store._ids)
+        return store
+
+
+# approximate nearest-neighbour search: an inverted file (IVF) index over k-means centroids
+class IVFVectorStore(NumpyVectorStore):
+    """NumpyVectorStore that only scores the rows in the `nprobe` clusters closest to the query.
+
+    Until `train` has been called (or centroids were loaded) searches fall back to the exact scan.
+    Rows added after training are assigned to their nearest centroid, so the index grows incrementally.
+    """
+
+    def __init__(self, embedding: Embeddings, nlist: Optional[int] = None, nprobe: int = 8, **kwargs: Any):
+        super().__init__(embedding, **kwargs)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self._centroids: Optional[np.ndarray] = None
+        self._lists: list[np.ndarray] = []
+        self._list_sizes = np.zeros(0, dtype=np.int64)
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    def _assign(self, rows: np.ndarray, block_size: int = 65536):
+        """Append `rows` to the inverted list of their nearest centroid."""
+        for i in range(0, len(rows), block_size):
+            block = rows[i:i + block_size]
+            labels = np.argmax(self._matrix[block] @ self._centroids.T, axis=1)
+            order = np.argsort(labels, kind="stable")
+            labels, block = labels[order], block[order]
+            boundaries = np.flatnonzero(np.diff(labels)) + 1
+            for label, members in zip(labels[np.r_[0, boundaries]], np.split(block, boundaries)):
+                size = self._list_sizes[label]
+                if size + len(members) > len(self._lists[label]):
+                    grown = np.zeros(max(size + len(members), 2 * len(self._lists[label]), 16), dtype=np.int64)
+                    grown[:size] = self._lists[label][:size]
+                    self._lists[label] = grown
+                self._lists[label][size:size + len(members)] = members
+                self._list_sizes[label] += len(members)
+
+    def _set_centroids(self, centroids: np.ndarray):
+        self._centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self._lists = [np.zeros(0, dtype=np.int64) for _ in range(len(centroids))]
+        self._list_sizes = np.zeros(len(centroids), dtype=np.int64)
+        self._assign(np.flatnonzero(self._alive[:self._size]))
+
+    def train(self, nlist: Optional[int] = None, n_iter: int = 20, max_train_size: int = 256, seed: int = 0):
+        """Cluster the stored vectors with spherical k-means and build the inverted lists.
+
+        At most `max_train_size` vectors per centroid are sampled for training.
+        """
+        rows = np.flatnonzero(self._alive[:self._size])
+        nlist = min(nlist or self.nlist or int(4 * np.sqrt(len(rows))), len(rows))
+        self.nlist = nlist
+        rng = np.random.default_rng(seed)
+        if len(rows) > nlist * max_train_size:
+            rows = rng.choice(rows, nlist * max_train_size, replace=False)
+        sample = self._matrix[rows]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(n_iter):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(labels, kind="stable")
+            counts = np.bincount(labels, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            sums[counts > 0] = np.add.reduceat(sample[order], np.r_[0, np.cumsum(counts)[:-1]][counts > 0])
+            # re-seed empty clusters with random training vectors
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = sums / np.where(norms == 0, 1, norms)
+        self._set_centroids(centroids)
+
+    def add_embeddings(self, texts, vectors, metadatas=None, ids=None) -> list[str]:
+        start = self._size
+        ids = super().add_embeddings(texts, vectors, metadatas, ids)
+        if self.is_trained:
+            self._assign(np.arange(start, self._size))
+        return ids
+
+    def _candidates(self, query: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """Live rows in the `nprobe` clusters closest to the query."""
+        probes = self._top_k(self._centroids @ query, nprobe or self.nprobe)
+        candidates = np.concatenate([self._lists[p][:self._list_sizes[p]] for p in probes])
+        if self._n_deleted:
+            candidates = candidates[self._alive[candidates]]
+        return candidates
+
+    def _search_rows(self, query: np.ndarray, k: int, nprobe: Optional[int] = None, **kwargs: Any):
+        if not self.is_trained:
+            return super()._search_rows(query, k)
+        candidates = self._candidates(query, nprobe)
+        scores = self._matrix[candidates] @ query
+        top = self._top_k(scores, k)
+        return candidates[top], scores[top]
+
+    def _save_arrays(self, path: str, rows: np.ndarray):
+        if not self.is_trained:
+            return
+        # snapshots only hold live rows, so the inverted lists are renumbered to match
+        renumber = np.full(self._size, -1, dtype=np.int64)
+        renumber[rows] = np.arange(len(rows))
+        lists = [renumber[members[:size]] for members, size in zip(self._lists, self._list_sizes)]
+        lists = [members[members >= 0] for members in lists]
+        np.savez(
+            os.path.join(path, "ivf.npz"),
+            centroids=self._centroids,
+            sizes=np.array([len(members) for members in lists], dtype=np.int64),
+            rows=np.concatenate(lists),
+        )
+
+    def _load_arrays(self, path: str):
+        ivf_path = os.path.join(path, "ivf.npz")
+        if not os.path.exists(ivf_path):
+            return
+        with np.load(ivf_path) as data:
+            self._centroids = data["centroids"]
+            self._list_sizes = data["sizes"]
+            self._lists = np.split(data["rows"], np.cumsum(self._list_sizes)[:-1])
+        self.nlist = len(self._centroids)
+
+
+def benchmark_ivf(store: IVFVectorStore, queries: np.ndarray, k: int = 10, nprobes=(1, 2, 4, 8, 16, 32)):
+    """Compare recall@k and per-query latency of the IVF search against the exact scan."""
+    queries = np.asarray(queries, dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    t0 = time.perf_counter()
+    exact = [set(NumpyVectorStore._search_rows(store, query, k)[0].tolist()) for query in queries]
+    exact_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+    results = [{"nprobe": "exact", "recall": 1.0, "latency_ms": exact_ms}]
+    for nprobe in nprobes:
+        t0 = time.perf_counter()
+        approx = [set(store._search_rows(query, k, nprobe=nprobe)[0].tolist()) for query in queries]
+        latency_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        recall = np.mean([len(a & e) / len(e) for a, e in zip(approx, exact)])
+        results.append({"nprobe": nprobe, "recall": float(recall), "latency_ms": latency_ms})
+    for result in results:
+        print(f"nprobe={result['nprobe']}: recall@{k}={result['recall']:.3f} latency={result['latency_ms']:.3f}ms")
+    return results
+
+
+# vector quantization: search compressed codes instead of the float32 rows
+# int8: one byte per dimension, scaled per dimension; the score is codes @ (scale * query)
+# pq: product quantization, the vector is split into `pq_m` subvectors, each replaced by the one-byte id
+# of its nearest centroid in a 256-entry codebook; scores are sums of per-subvector lookup tables computed
+# once per query (asymmetric distance computation: the query itself is not quantized)
+def kmeans(x: np.ndarray, k: int, n_iter: int = 20, seed: int = 0) -> np.ndarray:
+    """Euclidean k-means, returns the centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(n_iter):
+        distances = (centroids ** 2).sum(axis=1) - 2 * x @ centroids.T
+        labels = np.argmin(distances, axis=1)
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        sums[counts > 0] = np.add.reduceat(x[order], np.r_[0, np.cumsum(counts)[:-1]][counts > 0])
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        # re-seed empty clusters with random training vectors
+        centroids[~nonempty] = x[rng.choice(len(x), int((~nonempty).sum()))]
+    return centroids
+
+
+class QuantizedVectorStore(IVFVectorStore):
+    """IVFVectorStore that scores quantized codes instead of the float32 rows, once `train_quantizer` was called.
+
+    With `rerank_k`, the `rerank_k` best candidates by approximate score are rescored exactly against
+    their float rows. For a loaded snapshot the float rows stay memory-mapped on disk, so only the codes
+    are resident and only the rerank candidates are read from the float rows.
+    """
+
+    def __init__(self, embedding: Embeddings, quantization: Optional[str] = None, pq_m: int = 16, rerank_k: int = 0, **kwargs: Any):
+        super().__init__(embedding, **kwargs)
+        if quantization not in (None, "int8", "pq"):
+            raise ValueError(f"Unknown quantization: {quantization}")
+        self.quantization = quantization
+        self.pq_m = pq_m
+        self.rerank_k = rerank_k
+        self._codes: Optional[np.ndarray] = None
+        self._scale: Optional[np.ndarray] = None
+        self._codebooks: list[np.ndarray] = []
+
+    @property
+    def is_quantized(self) -> bool:
+        return self._codes is not None
+
+    def _subspaces(self, dim: int) -> list[slice]:
+        bounds = np.linspace(0, dim, min(self.pq_m, dim) + 1).astype(int)
+        return [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.quantization == "int8":
+            return np.clip(np.rint(vectors / self._scale), -127, 127).astype(np.int8)
+        codes = np.empty((len(vectors), len(self._codebooks)), dtype=np.uint8)
+        for j, (subspace, codebook) in enumerate(zip(self._subspaces(vectors.shape[1]), self._codebooks)):
+            sub = vectors[:, subspace]
+            codes[:, j] = np.argmin((codebook ** 2).sum(axis=1) - 2 * sub @ codebook.T, axis=1)
+        return codes
+
+    def _encode_rows(self, rows: np.ndarray, block_size: int = 65536):
+        if len(self._codes) < self._size:
+            grown = np.zeros(
+                (max(self._size, 2 * len(self._codes)), self._codes.shape[1]),
+                dtype=self._codes.dtype,
+                order="F" if self.quantization == "pq" else "C",
+            )
+            grown[:len(self._codes)] = self._codes
+            self._codes = grown
+        for i in range(0, len(rows), block_size):
+            block = rows[i:i + block_size]
+            self._codes[block] = self._encode(np.asarray(self._matrix[block]))
+
+    def train_quantizer(self, quantization: Optional[str] = None, max_train_size: int = 65536, n_iter: int = 20, seed: int = 0):
+        """Fit the quantizer on a sample of the stored vectors and encode all rows."""
+        self.quantization = quantization or self.quantization or "int8"
+        rows = np.flatnonzero(self._alive[:self._size])
+        rng = np.random.default_rng(seed)
+        if len(rows) > max_train_size:
+            rows = np.sort(rng.choice(rows, max_train_size, replace=False))
+        sample = np.asarray(self._matrix[rows])
+        dim = sample.shape[1]
+        if self.quantization == "int8":
+            self._scale = np.maximum(np.abs(sample).max(axis=0), 1e-12) / 127
+            self._codes = np.zeros((0, dim), dtype=np.int8)
+        else:
+            k = min(256, len(sample))
+            self._codebooks = [kmeans(sample[:, subspace], k, n_iter, seed) for subspace in self._subspaces(dim)]
+            # column-major, so that each subvector's codes are contiguous for the table lookups
+            self._codes = np.zeros((0, len(self._codebooks)), dtype=np.uint8, order="F")
+        self._encode_rows(np.arange(self._size))
+
+    def add_embeddings(self, texts, vectors, metadatas=None, ids=None) -> list[str]:
+        ids = super().add_embeddings(texts, vectors, metadatas, ids)
+        if self.is_quantized:
+            self._encode_rows(np.array([self._row_of[doc_id] for doc_id in ids], dtype=np.int64))
+        return ids
+
+    def _approximate_scores(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """Approximate cosine similarity of the query with `rows`, or with all rows."""
+        n = self._size if rows is None else len(rows)
+        if self.quantization == "int8":
+            # small blocks keep the float32 copy of the codes in cache
+            scores = np.empty(n, dtype=np.float32)
+            scaled = (self._scale * query).astype(np.float32)
+            for i in range(0, n, 1024):
+                # the codes are over-allocated, only the first n rows are in use
+                block = self._codes[i:min(i + 1024, n)] if rows is None else self._codes[rows[i:i + 1024]]
+                scores[i:i + len(block)] = block.astype(np.float32) @ scaled
+            return scores
+        codes = self._codes[:n] if rows is None else np.asfortranarray(self._codes[rows])
+        scores = np.zeros(n, dtype=np.float32)
+        for j, (subspace, codebook) in enumerate(zip(self._subspaces(len(query)), self._codebooks)):
+            scores += np.take((codebook @ query[subspace]).astype(np.float32), codes[:, j])
+        return scores
+
+    def _search_rows(self, query: np.ndarray, k: int, nprobe: Optional[int] = None, rerank_k: Optional[int] = None, **kwargs: Any):
+        if not self.is_quantized:
+            return super()._search_rows(query, k, nprobe=nprobe)
+        if self.is_trained:
+            candidates = self._candidates(query, nprobe)
+            scores = self._approximate_scores(query, candidates)
+        else:
+            candidates = None
+            scores = self._approximate_scores(query)
+            if self._n_deleted:
+                scores[~self._alive[:self._size]] = -np.inf
+        rerank_k = self.rerank_k if rerank_k is None else rerank_k
+        top = self._top_k(scores, max(rerank_k, min(k, len(self))))
+        rows = top if candidates is None else candidates[top]
+        if rerank_k:
+            # exact scores for the small candidate set, read from the float rows in file order
+            rows = np.sort(rows[self._alive[rows]])
+            scores = np.asarray(self._matrix[rows]) @ query
+            top = self._top_k(scores, k)
+            return rows[top], scores[top]
+        return rows[:k], scores[top][:k]
+
+    def bytes_per_vector(self) -> float:
+        """Resident bytes per vector of the codes; the codebooks are shared by all vectors."""
+        if not self.is_quantized:
+            return float(self._matrix.shape[1] * 4)
+        return float(self._codes.shape[1] * self._codes.itemsize)
+
+    def _save_arrays(self, path: str, rows: np.ndarray):
+        super()._save_arrays(path, rows)
+        if not self.is_quantized:
+            return
+        arrays = {"codes": self._codes[rows], "kind": np.array(self.quantization)}
+        if self.quantization == "int8":
+            arrays["scale"] = self._scale
+        else:
+            arrays["subspace_dims"] = np.array([codebook.shape[1] for codebook in self._codebooks])
+            arrays["codebooks"] = np.concatenate(self._codebooks, axis=1)
+        np.savez(os.path.join(path, "quantization.npz"), **arrays)
+
+    def _load_arrays(self, path: str):
+        super()._load_arrays(path)
+        quantization_path = os.path.join(path, "quantization.npz")
+        if not os.path.exists(quantization_path):
+            return
+        with np.load(quantization_path) as data:
+            self.quantization = str(data["kind"])
+            self._codes = data["codes"]
+            if self.quantization == "pq":
+                self._codes = np.asfortranarray(self._codes)
+            if self.quantization == "int8":
+                self._scale = data["scale"]
+            else:
+                bounds = np.cumsum(data["subspace_dims"])[:-1]
+                self._codebooks = np.split(data["codebooks"], bounds, axis=1)
+                self.pq_m = len(self._codebooks)
+
+
+def benchmark_quantization(vectors: np.ndarray, queries: np.ndarray, k: int = 10, pq_ms=(16, 32), rerank_k: int = 100):
+    """Memory per million vectors, queries/sec and recall@k of int8 and PQ against the float32 exact scan.
+    The Python float lists of InMemoryVectorStore take about 32 bytes per dimension (8-byte pointer and 24-byte float object).
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    dim = vectors.shape[1]
+
+    def run(store, **kwargs):
+        start = time.perf_counter()
+        results = [store._search_rows(query, k, **kwargs)[0] for query in queries]
+        return results, len(queries) / (time.perf_counter() - start)
+
+    exact_store = NumpyVectorStore(embedding=None)
+    exact_store.add_embeddings([""] * len(vectors), vectors)
+    exact, qps = run(exact_store)
+    exact = [set(rows.tolist()) for rows in exact]
+    results = [
+        {"index": "InMemoryVectorStore (python floats)", "mb_per_1m": dim * 32, "qps": None, "recall": None},
+        {"index": "float32", "mb_per_1m": dim * 4, "qps": qps, "recall": 1.0},
+    ]
+    configs = [("int8", {})] + [("pq", {"pq_m": m}) for m in pq_ms]
+    for quantization, kwargs in configs:
+        store = QuantizedVectorStore(embedding=None, quantization=quantization, **kwargs)
+        store.add_embeddings([""] * len(vectors), vectors)
+        store.train_quantizer()
+        name = quantization if quantization == "int8" else f"pq m={kwargs['pq_m']}"
+        for rerank in (0, rerank_k):
+            found, qps = run(store, rerank_k=rerank)
+            recall = np.mean([len(set(rows.tolist()) & e) / len(e) for rows, e in zip(found, exact)])
+            results.append({
+                "index": name + (f" + exact rerank of {rerank}" if rerank else ""),
+                "mb_per_1m": store.bytes_per_vector(),
+                "qps": qps,
+                "recall": float(recall),
+            })
+    for result in results:
+        qps = f"{result['qps']:.0f}" if result["qps"] is not None else "-"
+        recall = f"{result['recall']:.3f}" if result["recall"] is not None else "-"
+        print(f"{result['index']}: {result['mb_per_1m']:.0f} MB per 1M vectors, {qps} queries/s, recall@{k}={recall}")
+    return results
+
+
+# hybrid retrieval: fuse the dense and the BM25 rankings with reciprocal-rank fusion
+
+
+class HybridRetriever(BaseRetriever):
+    """Retrieve `fetch_k` candidates from the dense index and from its keyword index, and merge them
+    with reciprocal-rank fusion: score(d) = sum over rankings of 1 / (rrf_k + rank(d)).
+
+    Exact matches on names, error codes or identifiers are found by BM25 even when the
+    embedding puts them far from the query.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: NumpyVectorStore
+    k: int = 4
+    fetch_k: int = 20
+    rrf_k: int = 60
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        rankings = [[doc.id for doc in self.vectorstore.similarity_search(query, k=self.fetch_k)]]
+        if self.vectorstore.keyword_index is not None:
+            rankings.append([doc_id for doc_id, _ in self.vectorstore.keyword_index.search(query, k=self.fetch_k)])
+        return self.vectorstore.get_by_ids(reciprocal_rank_fusion(rankings, self.rrf_k)[:self.k])
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence], rrf_k: int = 60) -> list:
+    """Items of `rankings` by descending sum over rankings of 1 / (rrf_k + rank)."""
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] += 1 / (rrf_k + rank)
+    return sorted(fused, key=fused.get, reverse=True)
+
+
+# rerank: score (query, chunk) pairs with a reranker model and keep the best ones
+class OllamaReranker:
+    """Score (query, document) pairs in one request to an Ollama-compatible `/api/rerank` endpoint.
+
+    The endpoint takes {"model", "query", "documents"} and returns {"results": [{"index", "relevance_score"}]}.
+    Scores are cached by (query, chunk id), so only unseen chunks are sent to the model.
+    """
+
+    def __init__(self, model: str, base_url: str = "http://localhost:11434", timeout: float = 60, max_cached: int = 100_000):
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_cached = max_cached
+        self.session = requests.Session()
+        self.stats = Counter()
+        self._scores: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def score(self, query: str, docs: list[Document]) -> list[float]:
+        keys = [(query, doc.id or hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()) for doc in docs]
+        with self._lock:
+            scores = {key: self._scores[key] for key in keys if key in self._scores}
+            for key in scores:
+                self._scores.move_to_end(key)
+            self.stats["cache_hits"] += len(scores)
+        missing = [i for i, key in enumerate(keys) if key not in scores]
+        if missing:
+            start = time.perf_counter()
+            response = self.session.post(
+                f"{self.base_url}/api/rerank",
+                json={"model": self.model, "query": query, "documents": [docs[i].page_content for i in missing]},
+                timeout=self.timeout,
+            )
+            response.raise_for_status()
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.stats["calls"] += 1
+                self.stats["scored"] += len(missing)
+                self.stats["seconds"] += seconds
+                for result in response.json()["results"]:
+                    key = keys[missing[result["index"]]]
+                    scores[key] = self._scores[key] = float(result["relevance_score"])
+                while len(self._scores) > self.max_cached:
+                    self._scores.popitem(last=False)
+        return [scores.get(key, float("-inf")) for key in keys]
+
+
+class RerankRetriever(BaseRetriever):
+    """Over-fetch `fetch_k` candidates from `retriever` and keep the `k` best according to `reranker`,
+    like the rerank node of the agentic RAG graph.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    retriever: BaseRetriever
+    reranker: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        docs = self.retriever.invoke(query)
+        scores = self.reranker.score(query, docs)
+        order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)[:self.k]
+        return [docs[i] for i in order]
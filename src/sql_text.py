@@ -0,0 +1,57 @@
+# SQL text of 2_4_sql_agent.py: the tokenizer used by the static checks, and the canonical form of a query that
+# keys the result cache. Kept out of the script so that they can be tested
+import re
+
+
+SQL_TOKEN = re.compile(
+    r"""(?P<comment>--[^\n]*|/\*.*?(?:\*/|$))"""
+    r"""|(?P<string>'(?:[^']|'')*')"""
+    r"""|(?P<identifier>"(?:[^"]|"")*"|\[[^\]]*\]|`(?:[^`]|``)*`)"""
+    r"""|(?P<number>0[xX][0-9a-fA-F]+|(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)"""
+    r"""|(?P<word>\w+)"""
+    r"""|(?P<symbol>\S)""",
+    re.DOTALL,
+)
+
+
+# https://www.sqlite.org/lang_keywords.html; an identifier spelled like one of them must stay quoted
+SQLITE_KEYWORDS = frozenset("""
+    abort action add after all alter always analyze and as asc attach autoincrement before begin between by
+    cascade case cast check collate column commit conflict constraint create cross current current_date
+    current_time current_timestamp database default deferrable deferred delete desc detach distinct do drop
+    each else end escape except exclude exclusive exists explain fail filter first following for foreign from
+    full generated glob group groups having if ignore immediate in index indexed initially inner insert instead
+    intersect into is isnull join key last left like limit match materialized natural no not nothing notnull
+    null nulls of offset on or order others outer over partition plan pragma preceding primary query raise
+    range recursive references regexp reindex release rename replace restrict returning right rollback row rows
+    savepoint select set table temp temporary then ties to transaction trigger unbounded union unique update
+    using vacuum values view virtual when where window with without
+""".split())
+SIMPLE_IDENTIFIER = re.compile(r"(?!\d)\w+")
+
+
+def normalize_sql(query: str) -> str:
+    """A canonical form of `query`: comments, whitespace and trailing semicolons are dropped, keywords and
+    identifiers lowercased (SQLite compares them case-insensitively), [bracketed] and `backticked` identifiers
+    written bare when they need no quotes and in brackets otherwise, and integer literals written in decimal.
+    String literals, "double-quoted" tokens and other numbers are kept as they are, so that two queries with
+    the same canonical form return the same rows: SQLite reads a double-quoted token as a string literal when
+    no column has that name, so neither its case nor its quotes can be dropped.
+    """
+    tokens = []
+    for match in SQL_TOKEN.finditer(query):
+        kind, token = match.lastgroup, match.group()
+        if kind == "comment":
+            continue
+        if kind == "identifier" and token[0] != '"':
+            name = (token[1:-1].replace("``", "`") if token[0] == "`" else token[1:-1]).lower()
+            # brackets cannot contain "]", so the bracketed form is never confused with a string
+            token = name if SIMPLE_IDENTIFIER.fullmatch(name) and name not in SQLITE_KEYWORDS else f"[{name}]"
+        elif kind == "number" and re.fullmatch(r"0[xX][0-9a-fA-F]+|\d+", token):
+            token = str(int(token, 0 if token[:2].lower() == "0x" else 10))
+        elif kind not in ("string", "identifier"):
+            token = token.lower()
+        tokens.append(token)
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    return " ".join(tokens)
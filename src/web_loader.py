@@ -0,0 +1,161 @@
+# the web page loader of 2_2_agentic_rag.py: parallel, per-host limited, with retries and an on-disk HTTP cache.
+# Kept out of the script so that it can be tested against a local HTTP server
+# reference: HTTP conditional requests https://developer.mozilla.org/en-US/docs/Web/HTTP/Conditional_requests
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from bs4 import BeautifulSoup
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document
+
+
+class CachedWebLoader(BaseLoader):
+    """Load web pages like WebBaseLoader, with per-host concurrency limits and an on-disk cache.
+
+    Cached pages are revalidated with conditional GETs (ETag / Last-Modified), so an unchanged page
+    costs one 304 response and no HTML parsing. Every URL is retried with exponential backoff on
+    connection errors, 429 and 5xx responses. The outcome of each URL is recorded, and
+    `load(resume=True)` only fetches the URLs that did not succeed in the previous crawl.
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        cache_dir: str,
+        max_workers: int = 16,
+        max_per_host: int = 2,
+        max_retries: int = 4,
+        backoff: float = 1.0,
+        timeout: float = 30,
+    ):
+        self.urls = urls
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.failed: dict[str, str] = {}
+        self.stats = Counter()
+        self._host_limits: dict[str, threading.Semaphore] = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_cache(self, url: str) -> Optional[dict]:
+        try:
+            with open(self._cache_path(url), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_cache(self, url: str, entry: dict):
+        path = self._cache_path(url)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(path + ".tmp", path)
+
+    def _host_limit(self, url: str) -> threading.Semaphore:
+        with self._lock:
+            host = urlsplit(url).netloc
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.Semaphore(self.max_per_host)
+            return self._host_limits[host]
+
+    @staticmethod
+    def _parse(url: str, html: bytes) -> dict:
+        soup = BeautifulSoup(html, "html.parser")
+        # the same metadata as WebBaseLoader
+        metadata = {"source": url}
+        if title := soup.find("title"):
+            metadata["title"] = title.get_text()
+        if description := soup.find("meta", attrs={"name": "description"}):
+            metadata["description"] = description.get("content", "No description found.")
+        if html_tag := soup.find("html"):
+            metadata["language"] = html_tag.get("lang", "No language found.")
+        return {"page_content": soup.get_text(), "metadata": metadata}
+
+    def _fetch(self, url: str) -> dict:
+        cached = self._read_cache(url)
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._host_limit(url):
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+                if response.status_code == 304 and cached:
+                    self.stats["not_modified"] += 1
+                    return cached
+                if response.status_code == 429 or response.status_code >= 500:
+                    raise requests.HTTPError(f"{response.status_code} for {url}", response=response)
+                response.raise_for_status()
+                entry = {
+                    **self._parse(url, response.content),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+                self._write_cache(url, entry)
+                self.stats["downloaded"] += 1
+                return entry
+            except requests.RequestException as e:
+                # other 4xx responses will not change on retry
+                status = e.response.status_code if e.response is not None else None
+                if attempt == self.max_retries or (status is not None and status < 500 and status != 429):
+                    raise
+                self.stats["retries"] += 1
+                time.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    def _state_path(self) -> str:
+        return os.path.join(self.cache_dir, "crawl_state.json")
+
+    def load(self, resume: bool = False) -> list[Document]:
+        """Load all URLs. With `resume`, URLs that succeeded in the previous crawl are served from the cache."""
+        state = {}
+        if resume and os.path.exists(self._state_path()):
+            with open(self._state_path(), encoding="utf-8") as f:
+                state = json.load(f)
+
+        entries = {}
+        for url in self.urls:
+            if state.get(url) == "ok" and (cached := self._read_cache(url)):
+                entries[url] = cached
+                self.stats["resumed"] += 1
+        self.failed = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {pool.submit(self._fetch, url): url for url in self.urls if url not in entries}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    entries[url] = future.result()
+                    state[url] = "ok"
+                except requests.RequestException as e:
+                    self.failed[url] = repr(e)
+                    state[url] = "failed"
+                    self.stats["failed"] += 1
+
+        with open(self._state_path(), "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        return [
+            Document(page_content=entries[url]["page_content"], metadata=entries[url]["metadata"])
+            for url in self.urls
+            if url in entries
+        ]
+
+    def lazy_load(self):
+        yield from self.load()
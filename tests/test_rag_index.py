@@ -0,0 +1,276 @@
+import http.server
+import json
+import multiprocessing
+import os
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+import rag_index
+from rag_index import (
+    BM25Index, CachedTokenTextSplitter, NumpyVectorStore, OllamaReranker, QuantizedVectorStore, RerankRetriever,
+    merge_chunks,
+)
+
+
+class WordEncoding:
+    """One token per word, so that the tests do not download a tiktoken vocabulary.
+
+    Like a BPE vocabulary, it counts far fewer tokens than characters, which is what broke `add_start_index`.
+    """
+
+    def encode(self, text, allowed_special=(), disallowed_special=()):
+        return re.findall(r"\w+|[^\w\s]", text)
+
+
+@pytest.fixture
+def splitter(monkeypatch):
+    monkeypatch.setattr(rag_index.tiktoken, "get_encoding", lambda name: WordEncoding())
+    return CachedTokenTextSplitter(chunk_size=12, chunk_overlap=4)
+
+
+TEXT = (
+    "Agents call tools in a loop.\n\n"
+    "The retriever returns chunks. The retriever returns chunks. The retriever returns chunks.\n"
+    "Reward hacking is when an agent exploits a flaw in its reward function.\n\n\n"
+    "   Indented line with trailing spaces.   \n"
+    "Prompt engineering, also known as in-context prompting, steers the model without updating its weights. "
+    "The retriever returns chunks."
+)
+
+
+def test_chunk_spans_match_the_source_text(splitter):
+    chunks = splitter.create_documents([TEXT, TEXT * 3], metadatas=[{"source": "a"}, {"source": "b"}])
+    texts = {"a": TEXT, "b": TEXT * 3}
+    assert len(chunks) > 4
+    for chunk in chunks:
+        start, end = chunk.metadata["start_index"], chunk.metadata["end_index"]
+        assert start >= 0
+        assert texts[chunk.metadata["source"]][start:end] == chunk.page_content
+
+
+def test_chunk_spans_are_in_text_order(splitter):
+    chunks = splitter.create_documents([TEXT * 3])
+    starts = [chunk.metadata["start_index"] for chunk in chunks]
+    assert starts == sorted(set(starts))
+
+
+@pytest.mark.parametrize("chunk_size, chunk_overlap", [(12, 4), (50, 25), (7, 0), (30, 29)])
+def test_chunks_match_the_recursive_splitter(monkeypatch, chunk_size, chunk_overlap):
+    monkeypatch.setattr(rag_index.tiktoken, "get_encoding", lambda name: WordEncoding())
+    cached = CachedTokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    reference = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=lambda text: len(WordEncoding().encode(text))
+    )
+    for text in (TEXT, TEXT * 5, TEXT.replace("\n", " "), TEXT.replace(" ", ""), ""):
+        assert cached.split_text(text) == reference.split_text(text)
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="documents are only split in a pool with fork")
+def test_parallel_split_matches_the_in_process_split(splitter):
+    docs = [
+        Document(page_content=TEXT[i % len(TEXT):] + TEXT * (i % 4), metadata={"source": f"s{i}"})
+        for i in range(40)
+    ]
+    in_process = list(splitter.iter_split_documents(docs, min_parallel=len(docs) + 1))
+    parallel = list(splitter.iter_split_documents(docs, processes=3))
+    assert len(docs) >= 32 and len(parallel) > len(docs)
+    assert [(chunk.page_content, chunk.metadata) for chunk in parallel] == [
+        (chunk.page_content, chunk.metadata) for chunk in in_process
+    ]
+
+
+def chunk(text, source, start, end=None):
+    end = start + len(text) if end is None else end
+    return Document(page_content=text, metadata={"source": source, "start_index": start, "end_index": end})
+
+
+SOURCE = "Alpha beta gamma. Delta epsilon zeta.\nEta theta iota. Kappa lambda mu."
+
+
+def test_merge_chunks_merges_overlapping_and_touching_spans():
+    docs = [
+        chunk(SOURCE[18:37], "s", 18),
+        chunk(SOURCE[0:24], "s", 0),
+        chunk(SOURCE[38:], "s", 38),
+    ]
+    assert merge_chunks(docs) == [SOURCE.replace("\n", " ")]
+    assert merge_chunks(docs, {"s": SOURCE}) == [SOURCE]
+
+
+def test_merge_chunks_keeps_non_adjacent_chunks_apart():
+    docs = [chunk(SOURCE[54:], "s", 54), chunk(SOURCE[0:17], "s", 0), chunk(SOURCE[0:17], "other", 0)]
+    assert merge_chunks(docs) == [SOURCE[54:], SOURCE[0:17]]
+
+
+def test_merge_chunks_does_not_trust_invalid_spans():
+    docs = [
+        chunk(SOURCE[0:24], "s", 0),
+        # unknown start, and a start that is wrong: the text at 10 is not this chunk
+        chunk(SOURCE[38:53], "s", -1, -1),
+        chunk(SOURCE[54:], "s", 10),
+        chunk("Alpha beta gamma.", "s", 0, 40),
+        chunk(SOURCE[0:24], "s", 0),
+    ]
+    passages = merge_chunks(docs)
+    assert passages == [SOURCE[0:24], SOURCE[38:53], SOURCE[54:], "Alpha beta gamma."]
+    # with the source text, a span that does not match it is not trusted either
+    assert merge_chunks([chunk("Alpha beta", "s", 1)], {"s": SOURCE}) == ["Alpha beta"]
+    assert merge_chunks([chunk("Alpha beta", "s", 0), chunk("lpha beta gamma", "s", 1)], {"s": SOURCE}) == [
+        "Alpha beta gamma"
+    ]
+
+
+class NoEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        raise NotImplementedError
+
+    def embed_query(self, text):
+        raise NotImplementedError
+
+
+def test_snapshot_pruning_keeps_the_newest_versions_saved_within_one_second(tmp_path, monkeypatch):
+    # random suffixes in decreasing order, so that the newest version has the smallest name
+    suffixes = iter(range(0xfffffff0, 0, -1))
+    monkeypatch.setattr(rag_index.uuid, "uuid4", lambda: type("UUID", (), {"hex": f"{next(suffixes):08x}"})())
+    monkeypatch.setattr(rag_index.time, "strftime", lambda fmt: "20250101T000000")
+    store = NumpyVectorStore(NoEmbeddings())
+    versions = []
+    for i in range(4):
+        store.add_embeddings([f"text {i}"], [[1.0, float(i)]], ids=[str(i)])
+        versions.append(store.save_snapshot(str(tmp_path), {"model": "m"}, keep=2))
+        os.utime(tmp_path / versions[-1], ns=(i * 10**9, i * 10**9))
+    assert sorted(entry.name for entry in tmp_path.iterdir() if entry.is_dir()) == sorted(versions[-2:])
+    assert (tmp_path / "CURRENT").read_text() == versions[-1]
+    assert len(NumpyVectorStore.load_snapshot(str(tmp_path), NoEmbeddings(), {"model": "m"}).get_by_ids(["3"])) == 1
+
+
+def test_snapshot_pruning_never_deletes_the_current_version(tmp_path):
+    for i, name in enumerate(["a", "b", "c"]):
+        (tmp_path / name).mkdir()
+        os.utime(tmp_path / name, ns=(i * 10**9, i * 10**9))
+    # e.g. written by another process that saved an older version last
+    (tmp_path / "CURRENT").write_text("a")
+    NumpyVectorStore._prune_snapshots(str(tmp_path), keep=1)
+    assert sorted(entry.name for entry in tmp_path.iterdir() if entry.is_dir()) == ["a", "c"]
+
+
+@pytest.mark.parametrize("quantization", ["int8", "pq"])
+def test_quantized_store_searches_rows_added_after_training(quantization):
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((1500, 16)).astype(np.float32)
+    store = QuantizedVectorStore(NoEmbeddings(), quantization=quantization, pq_m=4, rerank_k=50)
+    store.add_embeddings([str(i) for i in range(1000)], vectors[:1000], ids=[str(i) for i in range(1000)])
+    store.train_quantizer()
+    store.add_embeddings([str(i) for i in range(1000, 1500)], vectors[1000:], ids=[str(i) for i in range(1000, 1500)])
+    for i in (3, 1200, 1499):
+        assert store.similarity_search_by_vector(vectors[i].tolist(), k=1)[0].id == str(i)
+
+
+def test_bm25_scores_with_summed_stats_match_one_index():
+    texts = {f"d{i}": text for i, text in enumerate([
+        "reward hacking in reinforcement learning", "reward tampering", "diffusion models for video",
+        "hallucination of language models", "reward models and reward hacking", "video generation",
+    ])}
+    whole, left, right = BM25Index(), BM25Index(), BM25Index()
+    whole.add(list(texts), list(texts.values()))
+    ids = list(texts)
+    left.add(ids[:2], [texts[i] for i in ids[:2]])
+    right.add(ids[2:], [texts[i] for i in ids[2:]])
+    query = "reward hacking video"
+    stats = {"n_docs": 0, "total_len": 0, "df": Counter()}
+    for index in (left, right):
+        shard_stats = index.term_stats(query)
+        stats["n_docs"] += shard_stats["n_docs"]
+        stats["total_len"] += shard_stats["total_len"]
+        stats["df"].update(shard_stats["df"])
+    merged = sorted(left.search(query, 10, stats) + right.search(query, 10, stats), key=lambda hit: -hit[1])
+    assert [doc_id for doc_id, _ in merged] == [doc_id for doc_id, _ in whole.search(query, 10)]
+    assert np.allclose([score for _, score in merged], [score for _, score in whole.search(query, 10)])
+
+
+class Rerank(http.server.BaseHTTPRequestHandler):
+    """An Ollama-compatible `/api/rerank`: the score of a document is the number of query words it contains."""
+
+    batches = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.batches.append(body)
+        words = set(body["query"].lower().split())
+        results = [
+            {"index": i, "relevance_score": len(words & set(document.lower().split()))}
+            for i, document in enumerate(body["documents"])
+        ]
+        out = json.dumps({"results": results[::-1]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+@pytest.fixture
+def reranker():
+    Rerank.batches.clear()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Rerank)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield OllamaReranker("stub", base_url=f"http://127.0.0.1:{server.server_address[1]}/")
+    server.shutdown()
+    server.server_close()
+
+
+CANDIDATES = [
+    Document(id="a", page_content="diffusion models for video"),
+    Document(id="b", page_content="reward hacking and reward tampering"),
+    Document(id="c", page_content="hallucination"),
+    Document(id="d", page_content="reward models"),
+    Document(id="e", page_content="agents exploit reward hacking loopholes"),
+]
+
+
+class Candidates(BaseRetriever):
+    def _get_relevant_documents(self, query, *, run_manager):
+        return CANDIDATES
+
+
+def test_reranker_scores_all_documents_in_one_request(reranker):
+    assert reranker.score("reward hacking", CANDIDATES) == [0, 2, 0, 1, 2]
+    assert len(Rerank.batches) == 1
+    assert Rerank.batches[0] == {"model": "stub", "query": "reward hacking", "documents": [d.page_content for d in CANDIDATES]}
+    assert reranker.stats["calls"] == 1 and reranker.stats["scored"] == 5
+
+
+def test_reranker_sends_only_unseen_chunks(reranker):
+    reranker.score("reward hacking", CANDIDATES[:3])
+    assert reranker.score("reward hacking", CANDIDATES) == [0, 2, 0, 1, 2]
+    assert [batch["documents"] for batch in Rerank.batches] == [
+        [d.page_content for d in CANDIDATES[:3]], [d.page_content for d in CANDIDATES[3:]]
+    ]
+    assert reranker.score("reward hacking", CANDIDATES[::-1]) == [2, 1, 0, 2, 0]
+    assert len(Rerank.batches) == 2 and reranker.stats["cache_hits"] == 3 + 5
+    reranker.score("video", CANDIDATES[:1])
+    assert len(Rerank.batches) == 3, "scores are cached per query"
+
+
+def test_reranker_cache_is_bounded(reranker):
+    reranker.max_cached = 2
+    reranker.score("reward hacking", CANDIDATES)
+    assert reranker.score("reward hacking", CANDIDATES) == [0, 2, 0, 1, 2]
+    assert len(Rerank.batches[1]["documents"]) == 3 and reranker.stats["cache_hits"] == 2
+
+
+def test_rerank_retriever_keeps_the_k_best(reranker):
+    retriever = RerankRetriever(retriever=Candidates(), reranker=reranker, k=3)
+    assert [doc.id for doc in retriever.invoke("reward hacking")] == ["b", "e", "d"]
+    assert [doc.id for doc in retriever.invoke("reward hacking")] == ["b", "e", "d"]
+    assert len(Rerank.batches) == 1
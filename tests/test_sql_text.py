@@ -0,0 +1,35 @@
+import sqlite3
+
+import pytest
+
+from sql_text import normalize_sql
+
+
+@pytest.fixture
+def connection():
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE Genre (GenreId INTEGER PRIMARY KEY, Name TEXT)")
+    connection.execute("INSERT INTO Genre (Name) VALUES ('Rock')")
+    yield connection
+    connection.close()
+
+
+@pytest.mark.parametrize("a, b", [
+    ("select  Name FROM [Genre]\nWHERE GenreId = 0x1; -- rock", "SELECT name FROM genre WHERE genreid = 1"),
+    ("SELECT `Name` FROM [Genre]", "SELECT NAME FROM GENRE;"),
+    ("SELECT [First Name] FROM t", "SELECT `first name` FROM t"),
+])
+def test_equivalent_queries_have_the_same_key(a, b):
+    assert normalize_sql(a) == normalize_sql(b)
+
+
+@pytest.mark.parametrize("a, b", [
+    # no column is named Rock, so SQLite reads "Rock" as a string literal
+    ('SELECT Name FROM Genre WHERE Name = "Rock"', 'SELECT Name FROM Genre WHERE Name = "rock"'),
+    ("SELECT Name FROM Genre WHERE Name = 'Rock'", "SELECT Name FROM Genre WHERE Name = 'rock'"),
+    ("SELECT current_date FROM Genre", "SELECT [current_date] FROM Genre"),
+])
+def test_queries_with_different_results_have_different_keys(connection, a, b):
+    connection.execute("ALTER TABLE Genre ADD COLUMN current_date TEXT")
+    assert connection.execute(a).fetchall() != connection.execute(b).fetchall()
+    assert normalize_sql(a) != normalize_sql(b)
@@ -0,0 +1,122 @@
+import http.server
+import threading
+from collections import Counter
+
+import pytest
+
+from web_loader import CachedWebLoader
+
+PAGE = b"<html lang='en'><head><title>Reward hacking</title></head><body><p>Reward tampering.</p></body></html>"
+LAST_MODIFIED = "Wed, 01 Oct 2025 00:00:00 GMT"
+
+
+class Site(http.server.BaseHTTPRequestHandler):
+    """`/page` supports conditional GETs, `/<status>-<n>` answers `status` n times and then the page,
+    `/missing` is always a 404. Requests and conditional requests are counted per path.
+    """
+
+    requests = Counter()
+    conditional = Counter()
+    etag_only = False
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path
+        self.requests[path] += 1
+        if path == "/missing":
+            return self._send(404)
+        if "-" in path:
+            status, failures = path[1:].split("-")
+            if self.requests[path] <= int(failures):
+                return self._send(int(status))
+        etag_matches = self.headers.get("If-None-Match") == '"v1"'
+        date_matches = not self.etag_only and self.headers.get("If-Modified-Since") == LAST_MODIFIED
+        if etag_matches or date_matches:
+            self.conditional[path] += 1
+            return self._send(304)
+        self._send(200, PAGE)
+
+    def _send(self, status, body=b""):
+        self.send_response(status)
+        if status in (200, 304):
+            if not self.etag_only:
+                self.send_header("Last-Modified", LAST_MODIFIED)
+            self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def site():
+    Site.requests.clear()
+    Site.conditional.clear()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Site)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def loader_for(urls, tmp_path, **kwargs):
+    return CachedWebLoader(urls, cache_dir=str(tmp_path), backoff=0, timeout=5, **kwargs)
+
+
+def test_unchanged_pages_are_revalidated_with_304(site, tmp_path):
+    url = f"{site}/page"
+    first = loader_for([url], tmp_path).load()
+    loader = loader_for([url], tmp_path)
+    second = loader.load()
+    assert first == second
+    assert first[0].metadata == {"source": url, "title": "Reward hacking", "language": "en"}
+    assert "Reward tampering." in first[0].page_content
+    assert Site.requests["/page"] == 2 and Site.conditional["/page"] == 1
+    assert loader.stats["not_modified"] == 1 and loader.stats["downloaded"] == 0
+
+
+def test_etag_alone_revalidates(site, tmp_path, monkeypatch):
+    monkeypatch.setattr(Site, "etag_only", True)
+    url = f"{site}/page"
+    loader_for([url], tmp_path).load()
+    loader = loader_for([url], tmp_path)
+    loader.load()
+    assert Site.conditional["/page"] == 1 and loader.stats["not_modified"] == 1
+
+
+@pytest.mark.parametrize("status", [500, 503, 429])
+def test_server_errors_and_rate_limits_are_retried(site, tmp_path, status):
+    url = f"{site}/{status}-2"
+    loader = loader_for([url], tmp_path, max_retries=2)
+    docs = loader.load()
+    assert len(docs) == 1 and not loader.failed
+    assert Site.requests[f"/{status}-2"] == 3 and loader.stats["retries"] == 2
+
+
+def test_retries_are_bounded(site, tmp_path):
+    url = f"{site}/503-5"
+    loader = loader_for([url], tmp_path, max_retries=2)
+    assert loader.load() == []
+    assert url in loader.failed and Site.requests["/503-5"] == 3
+
+
+@pytest.mark.parametrize("path", ["/missing", "/403-1"])
+def test_other_client_errors_are_not_retried(site, tmp_path, path):
+    loader = loader_for([f"{site}{path}"], tmp_path, max_retries=3)
+    assert loader.load() == []
+    assert Site.requests[path] == 1 and loader.stats["retries"] == 0
+
+
+def test_resume_fetches_only_the_failed_urls(site, tmp_path):
+    ok, flaky = f"{site}/page", f"{site}/503-1"
+    loader = loader_for([ok, flaky], tmp_path, max_retries=0)
+    assert [doc.metadata["source"] for doc in loader.load()] == [ok]
+    assert list(loader.failed) == [flaky]
+
+    loader = loader_for([ok, flaky], tmp_path, max_retries=0)
+    docs = loader.load(resume=True)
+    assert [doc.metadata["source"] for doc in docs] == [ok, flaky]
+    assert not loader.failed and loader.stats["resumed"] == 1
+    assert Site.requests["/page"] == 1 and Site.requests["/503-1"] == 2